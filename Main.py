@@ -1,20 +1,156 @@
+import time
+STARTUP_COUNTER = time.perf_counter()
+
 import pygame
-import librosa
 import numpy as np
 import os
-import time
+import sys
+import argparse
 import random
+import hashlib
+import json
+import struct
+import bisect
+from collections import OrderedDict, deque
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import importlib
+import threading
+import subprocess
+import statistics
+import tracemalloc
+import weakref
+import tempfile
+
+# Stands in for a module until one of its attributes is used, then imports it
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
 
-# Initialize pygame
-pygame.init()
+# The audio analysis stack (librosa pulls in numba, scipy and sklearn) is
+# only needed once a song is analyzed, so the menu doesn't wait for it.
+# numpy is imported by pygame anyway, so it is imported normally.
+librosa = LazyModule('librosa')
+soundfile = LazyModule('soundfile')
+soxr = LazyModule('soxr')
 
 # Game settings
 WIDTH, HEIGHT = 800, 600
 FPS = 60
-ARROW_SPEED = 5
-PERFECT_THRESHOLD = 30  # Increased for better hit detection
-GOOD_THRESHOLD = 50     # Increased for better hit detection
+SCROLL_SPEED = 300      # Pixels per second the arrows fall
+PERFECT_THRESHOLD = 100  # Milliseconds from the beat for a perfect hit
+GOOD_THRESHOLD = 165     # Milliseconds from the beat for a good hit (later counts as a miss)
+INPUT_POLL_INTERVAL = 0.001  # Seconds between input polls while waiting for the next frame
 HIT_LINE_Y = 500        # Y position of hit line
+ARROW_SIZE = 50
+DIRECTIONS = ['left', 'up', 'down', 'right']
+HIT_EFFECT_DURATION = 0.3   # Seconds the hit animation is shown
+HIT_EFFECT_FRAMES = 12      # Pre-rendered frames of the hit animation
+HIT_EFFECT_SIZE = 100       # Size of the hit animation sprites (fits the largest circle)
+TEXT_CACHE_SIZE = 256       # Rendered text surfaces kept for reuse
+DIRTY_RECT_RENDERING = False  # Only redraw and push the changed parts of the gameplay screen (toggle with F2)
+RENDER_BACKEND = 'software'   # 'software' blits onto the window surface, 'texture' draws GPU textures
+RENDER_VSYNC = False          # The texture renderer waits for the display refresh, so presses made meanwhile are read up to a refresh late
+PROFILER_KEY = pygame.K_F3      # Shows the frame time overlay
+PROFILER_HISTORY = 300          # Frames the overlay and log statistics are computed over
+PROFILER_HUD_REFRESH = 0.25     # Seconds between overlay updates
+PROFILER_HUD_POS = (580, 50)
+PROFILER_LOG_INTERVAL = 5.0     # Seconds between summaries with --profile
+PROFILER_HISTOGRAM_BINS = 20
+PROFILER_HISTOGRAM_BIN_MS = 2   # Width of a histogram bin; the last bin holds all longer frames
+ARROW_LEAD_TIME = (HIT_LINE_Y + ARROW_SIZE) / SCROLL_SPEED  # Seconds an arrow is on screen before its beat
+
+# Song clock settings
+AUDIO_OFFSET_MS = 0             # Increase if the music is heard later than the arrows reach the line
+CLOCK_DRIFT_CORRECTION = 0.1    # Fraction of the measured audio drift corrected at each mixer update
+CLOCK_RESYNC_THRESHOLD = 0.1    # Jump straight to the audio position if the clock is off by more (seconds)
+
+# Timing statistics and calibration settings
+TIMING_HISTORY = 4096           # Hit timing errors kept per session (the oldest are overwritten)
+TIMING_HISTOGRAM_BINS = 33      # Bins of the results screen histogram, spanning the good window
+CALIBRATION_PATH = os.path.join('cache', 'calibration.json')
+CALIBRATION_CLICKS = 32         # Clicks in the calibration track (120 BPM, one every CALIBRATION_INTERVAL)
+CALIBRATION_INTERVAL = 0.5
+CALIBRATION_WARMUP_CLICKS = 4   # Presses on the first clicks are ignored while the player finds the beat
+CALIBRATION_MIN_PRESSES = 8     # Presses needed for a result
+SUPPORTED_FORMATS = ['.mp3', '.wav', '.ogg']
+
+# Audio settings
+MIXER_SAMPLE_RATE = 44100       # Most decoded songs are 44.1 kHz, so the mixer plays them without resampling
+MIXER_BUFFER = 256              # Samples per mixer buffer (a power of two); larger if the sound crackles
+MIXER_CHANNELS = 16
+HIT_SOUND_CHANNELS = 4          # Mixer channels reserved for hit sounds, so nothing else delays them
+HIT_SOUNDS = {'perfect': os.path.join('assets', 'perfect.wav'), 'good': os.path.join('assets', 'hit.wav')}
+
+# Music analysis settings (stored with every cached beatmap)
+ANALYSIS_SAMPLE_RATE = 22050
+ANALYSIS_HOP_LENGTH = 512
+ANALYSIS_N_FFT = 2048
+ANALYSIS_N_MELS = 128
+STREAMING_MIN_DURATION = 600     # Tracks longer than this (in seconds) are analyzed in fixed-size blocks
+STREAMING_BLOCK_SIZE = 262144    # Samples decoded per block when streaming
+ANALYSIS_PROFILES = {            # Sample rate, hop length, frequency bands mapped to lanes and beat tracking
+    'fast': {'sr': 11025, 'hop_length': 1024, 'bands': 1, 'beat_track': False},
+    'standard': {'sr': ANALYSIS_SAMPLE_RATE, 'hop_length': ANALYSIS_HOP_LENGTH, 'bands': 1, 'beat_track': False},
+    'beat-tracked': {'sr': ANALYSIS_SAMPLE_RATE, 'hop_length': ANALYSIS_HOP_LENGTH, 'bands': 1, 'beat_track': True},
+    'high-quality': {'sr': 44100, 'hop_length': ANALYSIS_HOP_LENGTH, 'bands': len(DIRECTIONS), 'beat_track': False},
+}
+ANALYSIS_PROFILE = 'standard'
+BEAT_SUBDIVISIONS = 2            # Grid steps per beat that beat-tracked onsets are snapped to
+
+# Beatmap cache settings
+BEATMAP_CACHE_DIR = os.path.join('cache', 'beatmaps')
+BEATMAP_CACHE_MAX_BYTES = 32 * 1024 * 1024   # Evict least recently used beatmaps above this size
+BEATMAP_CACHE_MAX_AGE = 30 * 24 * 60 * 60    # Evict beatmaps not used for 30 days
+BEATMAP_MAGIC = b'HTBM'
+BEATMAP_VERSION = 4
+BEATMAP_HEADER = struct.Struct('<4sHII')     # magic, version, metadata length, onset count (then float64 times and strengths, and lanes)
+
+# Replay settings
+REPLAY_DIR = 'replays'
+REPLAY_MAGIC = b'HTRP'
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct('<4sHII')      # magic, version, metadata length, event count (then the encoded events)
+REPLAY_TICKS_PER_SECOND = 1000000            # Event times are stored in whole microseconds
+
+# Decoded audio cache settings
+PCM_CACHE_ENABLED = True
+PCM_CACHE_DIR = os.path.join('cache', 'pcm')
+PCM_CACHE_MAX_BYTES = 1024 * 1024 * 1024     # Evict least recently used decoded songs above this size
+PCM_CACHE_MAX_AGE = 30 * 24 * 60 * 60        # Evict decoded songs not played or analyzed for 30 days
+PCM_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')  # Canonical 16-bit PCM WAV header, so the mixer can play the file as is
+
+# Chart settings
+CHART_MAX_LANE_SPREAD = 4       # No lane gets more than this many notes ahead of the least used one
+DIFFICULTIES = {                # Share of the onsets kept (strongest first) and minimum seconds between notes
+    'easy': (0.35, 0.5),
+    'normal': (0.6, 0.3),
+    'hard': (0.85, 0.18),
+    'expert': (1.0, 0.0),
+}
+DIFFICULTY = 'normal'           # Default difficulty (Left/Right change it on the Get Ready screen)
+
+# Song library settings
+LIBRARY_INDEX_PATH = os.path.join('cache', 'library.json')
+LIBRARY_VERSION = 1
+LIBRARY_MIN_TEMPO = 70          # Estimated tempos are folded into this many BPM and twice as many
+LIBRARY_ROW_HEIGHT = 50         # Height of a row in the song list, including the gap below it
+
+# Background analysis settings
+ANALYSIS_WORKERS = 1            # Processes used for analysis while the game is running
+ANALYSIS_CANCEL_SLOTS = 64      # Recently cancelled jobs the workers can see
+SPECULATIVE_HOVER_DELAY = 0.4   # Seconds a song must be hovered before it is analyzed ahead of time
 
 # Colors
 WHITE = (255, 255, 255)
@@ -32,11 +168,100 @@ LIGHT_YELLOW = (255, 255, 224)
 GRAY = (100, 100, 100)
 DARK_GRAY = (50, 50, 50)
 
-# Create the game window
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Hit the beat")
+# Lane lookup tables, indexed by lane number (the position in DIRECTIONS)
+LANE_X = [200, 300, 400, 500]
+LANE_COLORS = [BLUE, GREEN, RED, YELLOW]
+LANE_LIGHT_COLORS = [LIGHT_BLUE, LIGHT_GREEN, LIGHT_RED, LIGHT_YELLOW]
+ARROW_POINTS = [
+    [(38, 10), (38, 40), (12, 25)],   # left
+    [(10, 38), (40, 38), (25, 12)],   # up
+    [(10, 12), (40, 12), (25, 38)],   # down
+    [(12, 10), (12, 40), (38, 25)],   # right
+]
+TARGET_POINTS = [
+    [(35, 10), (35, 40), (15, 25)],   # left
+    [(10, 35), (40, 35), (25, 15)],   # up
+    [(10, 15), (40, 15), (25, 35)],   # down
+    [(15, 10), (15, 40), (35, 25)],   # right
+]
+
+# Note states and judgements stored in a NoteChart
+NOTE_PENDING, NOTE_HIT, NOTE_MISS = 0, 1, 2
+JUDGE_NONE, JUDGE_PERFECT, JUDGE_GOOD = 0, 1, 2
+
+# The game window is only created by init_display, so analysis worker
+# processes can import this module without opening a window
+screen = None
+texture_display = None    # The TextureDisplay when the texture backend is used
 clock = pygame.time.Clock()
 
+# Initialize pygame and create the game window. With the texture backend,
+# scenes still draw on `screen`, which becomes an offscreen surface.
+def init_display():
+    global screen, texture_display
+    audio = get_audio()
+    audio.pre_init()
+    pygame.init()
+    audio.start()
+    
+    texture_display = None
+    if RENDER_BACKEND == 'texture':
+        if pygame.display.get_driver() in ('dummy', 'offscreen'):
+            print("No texture rendering with the dummy video driver, drawing in software")
+        else:
+            try:
+                texture_display = TextureDisplay("Hit the beat")
+                screen = pygame.Surface((WIDTH, HEIGHT), 0, 32)
+                return
+            except (ImportError, RuntimeError, pygame.error) as e:
+                print(f"Texture rendering unavailable ({e}), drawing in software")
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Hit the beat")
+
+# Convert a sprite to the window's pixel format for fast blits. The texture
+# backend has no window surface and uploads sprites as they are.
+def display_format(surface, alpha=False):
+    if texture_display:
+        return surface
+    return surface.convert_alpha() if alpha else surface.convert()
+
+# Show a frame drawn on `screen`
+def present_screen():
+    if texture_display:
+        texture_display.present_surface(screen)
+    else:
+        pygame.display.flip()
+
+# Fonts are created once per (name, size); SysFont looks up the system font database
+_fonts = {}
+
+def get_font(size, name=None):
+    key = (name, size)
+    font = _fonts.get(key)
+    if font is None:
+        font = pygame.font.SysFont(name, size)
+        _fonts[key] = font
+    return font
+
+# Rendered text surfaces, least recently used first
+_text_cache = OrderedDict()
+
+# Render text once and reuse the surface while the text stays the same.
+# The surface is shared, so callers must not draw on it (set_alpha before each blit is fine).
+def render_text(text, size, color, font_name=None):
+    key = (font_name, size, text, color)
+    surface = _text_cache.get(key)
+    if surface is not None:
+        _text_cache.move_to_end(key)
+        return surface
+    
+    surface = get_font(size, font_name).render(text, True, color)
+    profiler.count('surfaces')
+    _text_cache[key] = surface
+    if len(_text_cache) > TEXT_CACHE_SIZE:
+        _text_cache.popitem(last=False)
+    return surface
+
 # Button class for UI
 class Button:
     def __init__(self, x, y, width, height, text, color, hover_color, text_color=WHITE):
@@ -52,8 +277,7 @@ class Button:
         pygame.draw.rect(surface, color, self.rect)
         pygame.draw.rect(surface, WHITE, self.rect, 2)
         
-        font = pygame.font.SysFont(None, 28)
-        text_surf = font.render(self.text, True, self.text_color)
+        text_surf = render_text(self.text, 28, self.text_color)
         text_rect = text_surf.get_rect(center=self.rect.center)
         surface.blit(text_surf, text_rect)
         
@@ -63,574 +287,3104 @@ class Button:
     def is_clicked(self, mouse_pos, mouse_click):
         return self.rect.collidepoint(mouse_pos) and mouse_click
 
-# Get all music files in the assets directory
-def get_music_files():
-    music_files = []
+# Check if a file name has one of the supported audio formats
+def is_music_file(file_name):
+    return os.path.splitext(file_name)[1].lower() in SUPPORTED_FORMATS
+
+# Name shown for a song: the file name without extension, shortened to max_length
+def song_name(music_path, max_length=None):
+    name = os.path.splitext(os.path.basename(music_path))[0] if music_path else "Default Beat (Built-in)"
+    if max_length and len(name) > max_length:
+        name = name[:max_length - 3] + "..."
+    return name
+
+# Estimate a track's tempo from its onsets: the typical gap between
+# onsets, doubled or halved into the usual range of song tempos
+def estimate_tempo(onset_times):
+    intervals = np.diff(onset_times)
+    intervals = intervals[intervals > 0.05]
+    if len(intervals) == 0:
+        return None
+    tempo = 60.0 / float(np.median(intervals))
+    while tempo < LIBRARY_MIN_TEMPO:
+        tempo *= 2
+    while tempo > LIBRARY_MIN_TEMPO * 2:
+        tempo /= 2
+    return round(tempo, 1)
+
+# Length of a track in seconds from its header, or None if soundfile can't read it
+def read_duration(music_path):
+    try:
+        return soundfile.info(music_path).duration
+    except (RuntimeError, soundfile.LibsndfileError):
+        return None
+
+# Index of the music folder kept in the cache so large libraries don't
+# have to be re-read on every visit. Each entry holds the path, mtime,
+# size, duration, tempo and analysis status ('new', 'analyzed' or
+# 'failed') of a track; refresh only re-reads files whose mtime or size
+# changed since they were indexed.
+class SongLibrary:
+    def __init__(self, folder='assets', index_path=LIBRARY_INDEX_PATH):
+        self.folder = os.path.normpath(folder)
+        self.index_path = index_path
+        self.entries = {}
+        self.changed = False
+        self.load()
     
-    # Create assets directory if it doesn't exist
-    if not os.path.exists('assets'):
-        os.makedirs('assets')
+    def load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == LIBRARY_VERSION:
+                self.entries = {entry['path']: entry for entry in data['tracks']}
+        except (OSError, ValueError, KeyError, TypeError):
+            self.entries = {}
+    
+    def save(self):
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': LIBRARY_VERSION, 'tracks': list(self.entries.values())}, f)
+            os.replace(tmp_path, self.index_path)
+            self.changed = False
+        except OSError as e:
+            print(f"Could not save library index: {e}")
+    
+    # Rescan the folder, re-reading only new or modified files. Returns its entries sorted by name
+    def refresh(self):
+        os.makedirs(self.folder, exist_ok=True)
+        
+        # Tracks indexed from other folders (by --analyze-library) are kept as they are
+        found = {path: entry for path, entry in self.entries.items() if os.path.dirname(path) != self.folder}
+        tracks = []
+        with os.scandir(self.folder) as it:
+            for dir_entry in it:
+                if not is_music_file(dir_entry.name) or not dir_entry.is_file():
+                    continue
+                stat = dir_entry.stat()
+                entry = self.entries.get(dir_entry.path)
+                if entry is None or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+                    entry = {
+                        'path': dir_entry.path,
+                        'mtime_ns': stat.st_mtime_ns,
+                        'size': stat.st_size,
+                        'duration': read_duration(dir_entry.path),
+                        'tempo': None,
+                        'status': 'new',
+                    }
+                    self.changed = True
+                found[dir_entry.path] = entry
+                tracks.append(entry)
+        
+        if found.keys() != self.entries.keys():
+            self.changed = True
+        self.entries = found
+        self.save()
+        return sorted(tracks, key=lambda entry: os.path.basename(entry['path']).lower())
+    
+    # Store the outcome of analyzing a track
+    def record_analysis(self, music_path, status, onset_times=None, duration=None):
+        entry = self.entries.get(music_path)
+        if entry is None:
+            return
+        entry['status'] = status
+        if status == 'failed':
+            entry['tempo'] = None
+        elif onset_times is not None and len(onset_times):
+            entry['tempo'] = estimate_tempo(onset_times)
+        if duration:
+            entry['duration'] = duration
+        self.changed = True
+        self.save()
+
+_song_library = None
+
+def get_song_library():
+    global _song_library
+    if _song_library is None:
+        _song_library = SongLibrary()
+    return _song_library
+
+# Hash the contents of a music file so renamed or copied songs share a beatmap
+_content_hashes = {}
+
+def music_content_hash(music_path):
+    stat = os.stat(music_path)
+    memo_key = (os.path.abspath(music_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _content_hashes:
+        digest = hashlib.sha1()
+        with open(music_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        _content_hashes[memo_key] = digest.hexdigest()
+    return _content_hashes[memo_key]
+
+# Parameters a cached beatmap must match to be reused
+def analysis_params(profile=None):
+    profile = profile or ANALYSIS_PROFILE
+    return dict(ANALYSIS_PROFILES[profile], profile=profile, n_fft=ANALYSIS_N_FFT, n_mels=ANALYSIS_N_MELS,
+                beat_subdivisions=BEAT_SUBDIVISIONS, librosa=librosa.__version__)
+
+# Each analysis profile keeps its own beatmap of a song
+def beatmap_cache_path(content_hash, profile):
+    return os.path.join(BEATMAP_CACHE_DIR, f"{content_hash}.{profile}.btm")
+
+# Load a cached beatmap, or None if missing, corrupt or made with other parameters
+def load_beatmap(content_hash, params):
+    path = beatmap_cache_path(content_hash, params['profile'])
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, meta_len, count = BEATMAP_HEADER.unpack_from(data)
+        if magic != BEATMAP_MAGIC or version != BEATMAP_VERSION:
+            return None
+        meta_start = BEATMAP_HEADER.size
+        meta = json.loads(data[meta_start:meta_start + meta_len].decode('utf-8'))
+        if meta != params:
+            return None
+        onset_times = np.frombuffer(data, dtype='<f8', count=count, offset=meta_start + meta_len)
+        strengths = np.frombuffer(data, dtype='<f8', count=count, offset=meta_start + meta_len + 8 * count)
+        lanes = np.frombuffer(data, dtype=np.int8, count=count, offset=meta_start + meta_len + 16 * count)
+    except (OSError, ValueError, struct.error):
+        return None
     
-    # Supported audio formats
-    supported_formats = ['.mp3', '.wav', '.ogg']
+    # Mark the beatmap as recently used for eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return Beatmap(onset_times, strengths, lanes if count and lanes[0] >= 0 else None)
+
+# Write a beatmap to the cache as a small binary file. Times and strengths
+# keep full precision, so a chart built from the cached beatmap is exactly
+# the one built from the fresh analysis (replays check this).
+def save_beatmap(content_hash, params, beatmap):
+    os.makedirs(BEATMAP_CACHE_DIR, exist_ok=True)
+    path = beatmap_cache_path(content_hash, params['profile'])
+    meta = json.dumps(params, sort_keys=True).encode('utf-8')
+    onsets = np.asarray(beatmap.times, dtype='<f8')
+    strengths = np.asarray(beatmap.strengths, dtype='<f8')
+    lanes = np.full(len(onsets), -1, dtype=np.int8) if beatmap.lanes is None else beatmap.lanes.astype(np.int8)
     
-    # Find all music files in the assets directory
-    for file in os.listdir('assets'):
-        file_ext = os.path.splitext(file)[1].lower()
-        if file_ext in supported_formats:
-            music_files.append(file)
+    # Write to a temporary file first so a crash never leaves a half-written beatmap
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(BEATMAP_HEADER.pack(BEATMAP_MAGIC, BEATMAP_VERSION, len(meta), len(onsets)))
+            f.write(meta)
+            f.write(onsets.tobytes())
+            f.write(strengths.tobytes())
+            f.write(lanes.tobytes())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not cache beatmap: {e}")
+        return
+    evict_beatmaps()
+
+# Remove stale files from a cache folder, then the least recently used ones until it fits
+def evict_cache(folder, extension, max_bytes, max_age):
+    entries = []
+    now = time.time()
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if not entry.name.endswith(extension):
+                    continue
+                stat = entry.stat()
+                if now - stat.st_mtime > max_age:
+                    os.remove(entry.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError:
+        return
     
-    # If no music files found, create a placeholder
-    if not music_files:
-        print("No music files found in assets folder.")
-        print("Please add .mp3, .wav or .ogg files to assets folder.")
+    total_size = sum(size for _, size, _ in entries)
+    entries.sort()
+    for _, size, path in entries:
+        if total_size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+        except OSError:
+            pass
+
+def evict_beatmaps(max_bytes=BEATMAP_CACHE_MAX_BYTES, max_age=BEATMAP_CACHE_MAX_AGE):
+    evict_cache(BEATMAP_CACHE_DIR, '.btm', max_bytes, max_age)
+
+# Decoded songs are stored as 16-bit WAV files named after the content hash
+def pcm_cache_path(content_hash):
+    return os.path.join(PCM_CACHE_DIR, f"{content_hash}.wav")
+
+def pcm_header(sr, channels, frames):
+    block_align = 2 * channels
+    data_size = frames * block_align
+    return PCM_HEADER.pack(b'RIFF', PCM_HEADER.size - 8 + data_size, b'WAVE', b'fmt ', 16, 1, channels,
+                           sr, sr * block_align, block_align, 16, b'data', data_size)
+
+# Decode a song once into the PCM cache, block by block when soundfile can read it
+def transcode_to_pcm(music_path, pcm_path):
+    try:
+        info = soundfile.info(music_path)
+        sr, channels = info.samplerate, info.channels
+        blocks = soundfile.blocks(music_path, blocksize=STREAMING_BLOCK_SIZE, dtype='int16', always_2d=True)
+    except (RuntimeError, soundfile.LibsndfileError):
+        # soundfile can't read this format, so librosa decodes it in one go
+        y, sr = librosa.load(music_path, sr=None, mono=False)
+        y = np.atleast_2d(y).T
+        channels = y.shape[1]
+        blocks = [np.clip(np.round(y * 32768), -32768, 32767)]
+    
+    # The header is written last, once the number of decoded frames is known
+    os.makedirs(PCM_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{pcm_path}.{os.getpid()}.tmp"
+    try:
+        frames = 0
+        with open(tmp_path, 'wb') as f:
+            f.write(bytes(PCM_HEADER.size))
+            for block in blocks:
+                f.write(np.ascontiguousarray(block, dtype='<i2').tobytes())
+                frames += len(block)
+            f.seek(0)
+            f.write(pcm_header(sr, channels, frames))
+        os.replace(tmp_path, pcm_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    evict_cache(PCM_CACHE_DIR, '.wav', PCM_CACHE_MAX_BYTES, PCM_CACHE_MAX_AGE)
+
+# A decoded song in the PCM cache, memory-mapped so analysis reads it
+# through views of the page cache instead of decoding or copying it
+class DecodedAudio:
+    def __init__(self, pcm_path):
+        with open(pcm_path, 'rb') as f:
+            header = PCM_HEADER.unpack(f.read(PCM_HEADER.size))
+        riff, _, wave, fmt, fmt_size, audio_format, channels, sr, _, block_align, bits, data, data_size = header
+        if (riff, wave, fmt, data) != (b'RIFF', b'WAVE', b'fmt ', b'data') or (fmt_size, audio_format, bits) != (16, 1, 16):
+            raise ValueError(f"{pcm_path} is not a decoded song")
+        if channels < 1 or block_align != 2 * channels or data_size < block_align:
+            raise ValueError(f"{pcm_path} is empty")
+        self.path = pcm_path
+        self.samplerate = sr
+        self.channels = channels
+        self.frames = data_size // block_align
+        self.duration = self.frames / sr
+        self.data = np.memmap(pcm_path, dtype='<i2', mode='r', offset=PCM_HEADER.size, shape=(self.frames, channels))
+    
+    # Mono float samples, one block at a time
+    def blocks(self, blocksize):
+        for start in range(0, self.frames, blocksize):
+            yield self.data[start:start + blocksize].mean(axis=1, dtype=np.float32) / 32768
+    
+    # The whole song as mono float samples
+    def mono(self):
+        return self.data.mean(axis=1, dtype=np.float32) / 32768
+
+# Open the decoded copy of a song, decoding it first if it isn't cached.
+# Returns None if the song can't be decoded, so analysis decodes it itself.
+def load_decoded_audio(music_path, content_hash):
+    if not PCM_CACHE_ENABLED:
+        return None
+    pcm_path = pcm_cache_path(content_hash)
+    try:
+        try:
+            audio = DecodedAudio(pcm_path)
+        except (OSError, ValueError, struct.error):
+            transcode_to_pcm(music_path, pcm_path)
+            audio = DecodedAudio(pcm_path)
+        os.utime(pcm_path)
+        return audio
+    except Exception as e:
+        print(f"Could not cache decoded audio: {e}")
+        return None
+
+# The decoded copy of a song if there is one, which the mixer plays without decoding
+def playback_path(music_path):
+    if not PCM_CACHE_ENABLED:
+        return music_path
+    try:
+        pcm_path = pcm_cache_path(music_content_hash(music_path))
+        os.utime(pcm_path)
+        return pcm_path
+    except OSError:
+        return music_path
+
+# Raised by a progress callback to abandon an analysis in progress
+class AnalysisCancelled(Exception):
+    pass
+
+# Decide whether a track is long enough to be analyzed in blocks
+def use_streaming_analysis(music_path, audio=None):
+    if audio is not None:
+        return audio.duration > STREAMING_MIN_DURATION
+    try:
+        info = soundfile.info(music_path)
+    except (RuntimeError, soundfile.LibsndfileError):
+        # soundfile can't read this format, so it has to be decoded in one go
+        return False
+    return info.duration > STREAMING_MIN_DURATION
+
+# Stream a track as blocks of centered mel spectrogram frames in dB,
+# carrying the framing overlap and resampler state across blocks.
+# Blocks come from the decoded copy in `audio` if given, else from the file.
+def stream_mel_db(music_path, sr, hop_length, progress=None, progress_range=(0.0, 1.0), audio=None):
+    n_fft = ANALYSIS_N_FFT
+    if audio is None:
+        info = soundfile.info(music_path)
+        samplerate, total_samples = info.samplerate, max(info.frames, 1)
+        blocks = (block.mean(axis=1) for block in soundfile.blocks(music_path, blocksize=STREAMING_BLOCK_SIZE, dtype='float32', always_2d=True))
+    else:
+        samplerate, total_samples = audio.samplerate, audio.frames
+        blocks = audio.blocks(STREAMING_BLOCK_SIZE)
+    resampler = soxr.ResampleStream(samplerate, sr, 1, dtype='float32', quality='HQ') if samplerate != sr else None
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=ANALYSIS_N_MELS, fmax=0.5 * sr)
+    window = librosa.filters.get_window('hann', n_fft, fftbins=True).astype(np.float32)
+    
+    # Start with the zero padding librosa adds when centering frames
+    pending = np.zeros(n_fft // 2, dtype=np.float32)
+    
+    def frames_from(samples):
+        nonlocal pending
+        pending = np.concatenate([pending, samples])
+        if len(pending) < n_fft:
+            return None
+        frame_count = 1 + (len(pending) - n_fft) // hop_length
+        frames = np.lib.stride_tricks.sliding_window_view(pending, n_fft)[::hop_length][:frame_count]
+        power = np.abs(np.fft.rfft(frames * window, axis=1)) ** 2
+        pending = pending[frame_count * hop_length:]
+        return librosa.power_to_db(mel_basis @ power.T, top_db=None)
+    
+    samples_read = 0
+    start, end = progress_range
+    for mono in blocks:
+        samples_read += len(mono)
+        mel_db = frames_from(resampler.resample_chunk(mono) if resampler else mono)
+        if mel_db is not None:
+            yield mel_db
+        if progress:
+            progress(start + (end - start) * samples_read / total_samples, "Detecting beats")
+    
+    # Flush the resampler and add the trailing centering pad
+    tail = resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True) if resampler else np.zeros(0, dtype=np.float32)
+    mel_db = frames_from(np.concatenate([tail, np.zeros(n_fft // 2, dtype=np.float32)]))
+    if mel_db is not None:
+        yield mel_db
+
+# Onset strength envelopes computed block by block with constant memory.
+# Matches librosa.onset.onset_strength_multi (positive first difference
+# of the mel spectrogram in dB, averaged over `bands` equal groups of mel
+# bands). librosa floors the spectrogram 80 dB below its loudest frame,
+# so a first pass finds that maximum and a second pass computes the
+# envelopes. Returns an array of shape (bands, frames).
+def streaming_onset_strength(music_path, sr, hop_length, progress=None, bands=1, audio=None):
+    max_db = -np.inf
+    for mel_db in stream_mel_db(music_path, sr, hop_length, progress, (0.05, 0.45), audio):
+        max_db = max(max_db, mel_db.max())
+    floor_db = max_db - 80.0
+    
+    previous_db = None
+    n_frames = 0
+    envelope = [np.zeros((bands, 1 + ANALYSIS_N_FFT // (2 * hop_length)), dtype=np.float32)]
+    for mel_db in stream_mel_db(music_path, sr, hop_length, progress, (0.45, 0.9), audio):
+        n_frames += mel_db.shape[1]
+        mel_db = np.maximum(mel_db, floor_db)
+        if previous_db is not None:
+            mel_db = np.concatenate([previous_db, mel_db], axis=1)
+        flux = np.maximum(0.0, np.diff(mel_db, axis=1))
+        envelope.append(flux.reshape(bands, -1, flux.shape[1]).mean(axis=1).astype(np.float32))
+        previous_db = mel_db[:, -1:]
+    
+    return np.concatenate(envelope, axis=1)[:, :n_frames]
+
+# Detect onsets (when there's a note/beat) in the audio file with the
+# settings of an analysis profile (default: ANALYSIS_PROFILE), reading
+# the decoded copy in `audio` (a DecodedAudio) instead if given
+def detect_onsets(music_path, progress=None, profile=None, audio=None):
+    settings = ANALYSIS_PROFILES[profile or ANALYSIS_PROFILE]
+    sr, hop_length, bands = settings['sr'], settings['hop_length'], settings['bands']
+    
+    # Long tracks are analyzed without holding the whole decoded track in memory
+    if use_streaming_analysis(music_path, audio):
+        band_env = streaming_onset_strength(music_path, sr, hop_length, progress, bands, audio)
+    else:
+        # Load the audio file
+        if progress:
+            progress(0.05, "Decoding")
+        if audio is None:
+            y, sr = librosa.load(music_path, sr=sr)
+        else:
+            y = audio.mono()
+            if audio.samplerate != sr:
+                y = librosa.resample(y, orig_sr=audio.samplerate, target_sr=sr, res_type='soxr_hq')
         
-        # Add a default song option (will use built-in beat pattern)
-        music_files.append("Default Beat (Built-in)")
+        # Get onset strength per group of mel bands
+        if progress:
+            progress(0.6, "Detecting beats")
+        channels = np.linspace(0, ANALYSIS_N_MELS, bands + 1).astype(int)
+        band_env = librosa.onset.onset_strength_multi(y=y, sr=sr, n_fft=ANALYSIS_N_FFT, hop_length=hop_length, n_mels=ANALYSIS_N_MELS, channels=channels)
+    
+    if progress:
+        progress(0.9, "Picking beats")
+    return pick_onsets(band_env, sr, hop_length, settings)
+
+# Pick onsets from per-band onset envelopes. The bands are equally wide,
+# so their mean is the envelope of the whole spectrum. With several bands,
+# each onset goes to the lane of the band that rose the most (low to high
+# frequencies from left to right).
+def pick_onsets(band_env, sr, hop_length, settings):
+    onset_env = band_env.mean(axis=0)
+    onset_frames = librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr, hop_length=hop_length)
+    strengths = onset_env[onset_frames]
+    lanes = band_env[:, onset_frames].argmax(axis=0) if settings['bands'] > 1 else None
+    if settings['beat_track']:
+        return snap_to_beats(onset_env, onset_frames, strengths, lanes, sr, hop_length)
+    
+    # Convert frames to time (in seconds)
+    onset_times = librosa.frames_to_time(onset_frames, sr=sr, hop_length=hop_length)
+    return Beatmap(onset_times, strengths, lanes)
+
+# Move onsets onto the tempo grid of the beat tracker: every beat split
+# into BEAT_SUBDIVISIONS steps. Onsets landing on the same grid point are
+# merged into the strongest one, and onsets outside the tracked beats dropped.
+def snap_to_beats(onset_env, onset_frames, strengths, lanes, sr, hop_length):
+    onset_times = librosa.frames_to_time(onset_frames, sr=sr, hop_length=hop_length)
+    _, beat_frames = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=hop_length)
+    if len(beat_frames) < 2:
+        return Beatmap(onset_times, strengths, lanes)
+    beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=hop_length)
+    steps = np.arange(BEAT_SUBDIVISIONS) / BEAT_SUBDIVISIONS
+    grid = np.append((beat_times[:-1, None] + np.diff(beat_times)[:, None] * steps).ravel(), beat_times[-1])
     
-    return music_files
+    # Nearest grid point of each onset, if it is within half a step
+    right = np.clip(np.searchsorted(grid, onset_times), 1, len(grid) - 1)
+    nearest = np.where(onset_times - grid[right - 1] < grid[right] - onset_times, right - 1, right)
+    half_step = np.diff(grid)[np.minimum(nearest, len(grid) - 2)] / 2
+    on_grid = np.flatnonzero(np.abs(onset_times - grid[nearest]) <= half_step)
+    
+    strongest_first = on_grid[np.argsort(-strengths[on_grid], kind='stable')]
+    _, first = np.unique(nearest[strongest_first], return_index=True)
+    kept = np.sort(strongest_first[first])
+    return Beatmap(grid[nearest[kept]], strengths[kept], None if lanes is None else lanes[kept])
+
+# Beats used when there is no music or it can't be analyzed
+def default_beatmap():
+    return Beatmap(np.linspace(1, 60, 30))  # 30 beats over 60 seconds
 
-# Song selection screen
-def song_selection_screen():
-    music_files = get_music_files()
-    selected_song = None
+# Beatmap of a song from the cache or a fresh analysis; raises if the song can't be analyzed
+# progress(fraction, stage) is called between analysis steps and may raise AnalysisCancelled
+def load_or_analyze(music_path, progress=None, profile=None):
+    # Reuse the cached beatmap if this exact audio was analyzed before
+    content_hash = music_content_hash(music_path)
+    params = analysis_params(profile)
+    beatmap = load_beatmap(content_hash, params)
+    if beatmap is not None:
+        print(f"Loaded {len(beatmap)} beats from cache")
+        # Songs analyzed before the PCM cache existed get their decoded copy now, for playback
+        if progress:
+            progress(0.0, "Decoding")
+        load_decoded_audio(music_path, content_hash)
+        return beatmap
     
-    # Create buttons for each song
-    buttons = []
-    start_y = 150
-    button_height = 50
-    button_spacing = 20
-    button_width = 500
+    # Decode the song once into the PCM cache; later analyses and playback read that copy
+    start = time.perf_counter()
+    if progress:
+        progress(0.0, "Decoding")
+    audio = load_decoded_audio(music_path, content_hash)
+    beatmap = detect_onsets(music_path, progress, params['profile'], audio)
+    elapsed = time.perf_counter() - start
+    save_beatmap(content_hash, params, beatmap)
+    
+    # Report what the profile cost, as audio seconds analyzed per second when the length is known
+    duration = read_duration(music_path)
+    speed = f", {duration / elapsed:.0f}x real time" if duration else ""
+    print(f"Detected {len(beatmap)} beats in {elapsed:.2f}s ({params['profile']} profile{speed})")
+    return beatmap
+
+# Function to analyze beats in the music
+def analyze_music(music_path, progress=None, profile=None):
+    try:
+        return load_or_analyze(music_path, progress, profile)
+    except AnalysisCancelled:
+        raise
+    except Exception as e:
+        print(f"Error analyzing music: {e}")
+        # Return some dummy beats for testing if music analysis fails
+        return default_beatmap()
+
+# State shared with each analysis worker process
+_worker_progress_queue = None
+_worker_cancelled_jobs = None
+
+def _init_analysis_process(progress_queue, cancelled_jobs):
+    global _worker_progress_queue, _worker_cancelled_jobs
+    _worker_progress_queue = progress_queue
+    _worker_cancelled_jobs = cancelled_jobs
+
+# Runs in a worker process: import the analysis libraries before the first song arrives
+def _warm_up_analysis():
+    librosa.onset
+    return True
+
+# Runs in a worker process: analyze one song, reporting progress to the game.
+# Returns the beatmap and 'analyzed', or the default beats and 'failed'.
+def _run_analysis_job(job_id, music_path, profile):
+    def report(fraction, stage):
+        if job_id in _worker_cancelled_jobs[:]:
+            raise AnalysisCancelled()
+        _worker_progress_queue.put((job_id, fraction, stage))
     
-    for i, music_file in enumerate(music_files):
-        # Show just the filename without extension for better display
-        display_name = os.path.splitext(music_file)[0]
+    # Jobs cancelled while queued for this process never start
+    report(0.0, "Starting")
+    try:
+        beatmap, status = load_or_analyze(music_path, progress=report, profile=profile), 'analyzed'
+    except AnalysisCancelled:
+        raise
+    except Exception as e:
+        print(f"Error analyzing music: {e}")
+        beatmap, status = default_beatmap(), 'failed'
+    _worker_progress_queue.put((job_id, 1.0, "Ready"))
+    return beatmap, status
+
+# A song being analyzed in the background
+class AnalysisJob:
+    def __init__(self, job_id, music_path, future):
+        self.job_id = job_id
+        self.music_path = music_path
+        self.future = future
+        self.progress = 0.0
+        self.stage = "Waiting"
+        self.cancelled = False
         
-        # Truncate if name is too long
-        if len(display_name) > 40:
-            display_name = display_name[:37] + "..."
-            
-        btn = Button(
-            WIDTH//2 - button_width//2,
-            start_y + (button_height + button_spacing) * i,
-            button_width,
-            button_height,
-            display_name,
-            DARK_GRAY,
-            GRAY
-        )
-        buttons.append((btn, music_file))
+    def done(self):
+        return self.future.done()
+    
+    # Beatmap of a finished job (falls back to the default beats if the worker failed)
+    def result(self):
+        return self.outcome()[0]
     
-    # Add back button
-    back_button = Button(30, HEIGHT - 70, 120, 40, "Back", RED, LIGHT_RED)
+    # Whether a finished job 'analyzed' its song or 'failed' and fell back to the default beats
+    def status(self):
+        return self.outcome()[1]
     
-    # Selection screen loop
-    running = True
-    while running:
-        mouse_pos = pygame.mouse.get_pos()
-        mouse_click = False
+    def outcome(self):
+        try:
+            return self.future.result()
+        except AnalysisCancelled:
+            raise
+        except Exception as e:
+            print(f"Error analyzing music: {e}")
+            return default_beatmap(), 'failed'
+
+# Runs analyze_music in a process pool so the game keeps drawing frames
+class AnalysisWorker:
+    def __init__(self, max_workers=ANALYSIS_WORKERS):
+        # Spawn fresh processes instead of forking the initialized SDL state
+        self.context = multiprocessing.get_context('spawn')
+        self.max_workers = max_workers
+        self.progress_queue = self.context.Queue()
         
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                return None  # Exit game
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    return None  # Back to main menu
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                if event.button == 1:  # Left mouse button
-                    mouse_click = True
-        
-        # Clear screen
-        screen.fill(BLACK)
-        
-        # Draw title
-        font = pygame.font.SysFont(None, 48)
-        title = font.render("Select a Song", True, WHITE)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 50))
-        
-        # Update and draw buttons
-        for btn, music_file in buttons:
-            btn.update(mouse_pos)
-            btn.draw(screen)
-            
-            # Check for click
-            if btn.is_clicked(mouse_pos, mouse_click):
-                # If it's the default song, return None
-                if music_file == "Default Beat (Built-in)":
-                    selected_song = None
-                else:
-                    selected_song = os.path.join("assets", music_file)
-                running = False
-        
-        # Update and draw back button
-        back_button.update(mouse_pos)
-        back_button.draw(screen)
-        if back_button.is_clicked(mouse_pos, mouse_click):
-            return None  # Back to main menu
-            
-        # Draw instructions
-        font = pygame.font.SysFont(None, 24)
-        instructions = font.render("Click on a song to play", True, WHITE)
-        screen.blit(instructions, (WIDTH//2 - instructions.get_width()//2, HEIGHT - 50))
+        # Ids of the last ANALYSIS_CANCEL_SLOTS cancelled jobs, so each cancel
+        # reaches its own job even when several are queued or running
+        self.cancelled_jobs = self.context.Array('i', ANALYSIS_CANCEL_SLOTS)
+        self.cancel_count = 0
+        self.start_executor()
+        self.jobs = {}
+        self.next_job_id = 1
+        self.speculative_job = None
+    
+    def start_executor(self):
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=self.context,
+            initializer=_init_analysis_process,
+            initargs=(self.progress_queue, self.cancelled_jobs),
+        )
+    
+    # Submit to the pool, replacing it if a worker process died (out of
+    # memory, a crashing decoder), which leaves the pool unusable
+    def run(self, fn, *args):
+        try:
+            return self.executor.submit(fn, *args)
+        except BrokenProcessPool:
+            print("Analysis worker stopped unexpectedly, restarting it")
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.start_executor()
+            return self.executor.submit(fn, *args)
         
-        pygame.display.flip()
-        clock.tick(FPS)
-    
-    return selected_song
-
-# Load assets (create a folder named 'assets' and place your music there)
-def load_assets():
-    # Create directories if they don't exist
-    if not os.path.exists('assets'):
-        os.makedirs('assets')
-    
-    # Let user select a song
-    selected_song = song_selection_screen()
-    
-    # If the user selected a song, return it
-    if selected_song:
-        return selected_song
-    
-    # If no song was selected or no music files found, use default
-    print("Using a built-in beat pattern for now")
-    return None
-
-# Arrow class for falling arrows
-class Arrow:
-    def __init__(self, direction, spawn_time):
-        self.direction = direction
-        self.spawn_time = spawn_time
-        self.y = 0
-        self.width = 50
-        self.height = 50
-        
-        # Set x position based on direction
-        if direction == 'left':
-            self.x = 200
-            self.color = BLUE
-            self.light_color = LIGHT_BLUE
-        elif direction == 'up':
-            self.x = 300
-            self.color = GREEN
-            self.light_color = LIGHT_GREEN
-        elif direction == 'down':
-            self.x = 400
-            self.color = RED
-            self.light_color = LIGHT_RED
-        elif direction == 'right':
-            self.x = 500
-            self.color = YELLOW
-            self.light_color = LIGHT_YELLOW
-        
-        self.hit = False
-        self.miss = False
-        self.hit_time = 0
-        self.hit_type = None  # 'perfect' or 'good'
-        
-    def update(self, current_time):
-        if not self.hit and not self.miss:
-            self.y += ARROW_SPEED
-            if self.y > HEIGHT:
-                self.miss = True
-        elif self.hit and current_time - self.hit_time < 0.3:
-            # Keep showing hit animation for a short time
-            pass
+    # Start analyzing a song, or return the job already analyzing it
+    def submit(self, music_path):
+        job = self.jobs.get(music_path)
+        if job and not job.cancelled and not (job.done() and job.future.exception()):
+            return job
         
-    def draw(self, screen):
-        if self.hit and time.time() - self.hit_time < 0.3:
-            # Draw hit feedback animation
-            alpha = 255 - int(255 * (time.time() - self.hit_time) / 0.3)
-            if alpha < 0:
-                alpha = 0
-                
-            hit_text = "PERFECT!" if self.hit_type == 'perfect' else "GOOD!"
-            hit_color = CYAN if self.hit_type == 'perfect' else GREEN
-            font = pygame.font.SysFont(None, 28)
-            text = font.render(hit_text, True, hit_color)
-            text.set_alpha(alpha)
-            screen.blit(text, (self.x, HIT_LINE_Y - 30))
-            
-            # Draw a fading circle effect
-            radius = int(30 * (time.time() - self.hit_time) / 0.3) + 20
-            circle_surf = pygame.Surface((radius*2, radius*2), pygame.SRCALPHA)
-            pygame.draw.circle(circle_surf, (*self.color[:3], alpha), (radius, radius), radius)
-            screen.blit(circle_surf, (self.x + self.width//2 - radius, HIT_LINE_Y + self.height//2 - radius))
-            
-        elif not self.hit and not self.miss:
-            # Draw the arrow
-            pygame.draw.rect(screen, self.color, (self.x, self.y, self.width, self.height))
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        future = self.run(_run_analysis_job, job_id, music_path, ANALYSIS_PROFILE)
+        job = AnalysisJob(job_id, music_path, future)
+        self.jobs[music_path] = job
+        return job
+    
+    # Start the worker process and load librosa in it ahead of time
+    def warm_up(self):
+        self.run(_warm_up_analysis)
+    
+    # Analyze a song the player will probably pick, dropping the previous guess
+    def speculate(self, music_path):
+        previous = self.speculative_job
+        if previous and previous.music_path == music_path and not previous.cancelled:
+            return previous
+        if previous and not previous.done():
+            self.cancel(previous)
+        self.speculative_job = self.submit(music_path)
+        return self.speculative_job
+    
+    # Stop a job; a running job stops at its next progress report
+    def cancel(self, job):
+        if job.done():
+            return
+        job.cancelled = True
+        if not job.future.cancel():
+            self.cancelled_jobs[self.cancel_count % ANALYSIS_CANCEL_SLOTS] = job.job_id
+            self.cancel_count += 1
+        if self.jobs.get(job.music_path) is job:
+            del self.jobs[job.music_path]
+        if self.speculative_job is job:
+            self.speculative_job = None
             
-            # Draw arrow direction indicator with better visibility
-            if self.direction == 'left':
-                pygame.draw.polygon(screen, WHITE, [(self.x + 38, self.y + 10), (self.x + 38, self.y + 40), (self.x + 12, self.y + 25)])
-                # Draw outline for better visibility
-                pygame.draw.polygon(screen, BLACK, [(self.x + 38, self.y + 10), (self.x + 38, self.y + 40), (self.x + 12, self.y + 25)], 2)
-            elif self.direction == 'up':
-                pygame.draw.polygon(screen, WHITE, [(self.x + 10, self.y + 38), (self.x + 40, self.y + 38), (self.x + 25, self.y + 12)])
-                pygame.draw.polygon(screen, BLACK, [(self.x + 10, self.y + 38), (self.x + 40, self.y + 38), (self.x + 25, self.y + 12)], 2)
-            elif self.direction == 'down':
-                pygame.draw.polygon(screen, WHITE, [(self.x + 10, self.y + 12), (self.x + 40, self.y + 12), (self.x + 25, self.y + 38)])
-                pygame.draw.polygon(screen, BLACK, [(self.x + 10, self.y + 12), (self.x + 40, self.y + 12), (self.x + 25, self.y + 38)], 2)
-            elif self.direction == 'right':
-                pygame.draw.polygon(screen, WHITE, [(self.x + 12, self.y + 10), (self.x + 12, self.y + 40), (self.x + 38, self.y + 25)])
-                pygame.draw.polygon(screen, BLACK, [(self.x + 12, self.y + 10), (self.x + 12, self.y + 40), (self.x + 38, self.y + 25)], 2)
+    # Collect progress reports from the workers (call once per frame)
+    def poll(self):
+        jobs_by_id = {job.job_id: job for job in self.jobs.values()}
+        while True:
+            try:
+                job_id, fraction, stage = self.progress_queue.get_nowait()
+            except queue.Empty:
+                break
+            job = jobs_by_id.get(job_id)
+            if job:
+                job.progress = fraction
+                job.stage = stage
+                
+    def shutdown(self):
+        for job in list(self.jobs.values()):
+            self.cancel(job)
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
-# Function to analyze beats in the music
-def analyze_music(music_path):
-    try:
-        # Load the audio file and calculate tempo and beat frames
-        y, sr = librosa.load(music_path)
+_analysis_worker = None
+
+def get_analysis_worker():
+    global _analysis_worker
+    if _analysis_worker is None:
+        _analysis_worker = AnalysisWorker()
+    return _analysis_worker
+
+def shutdown_analysis_worker():
+    global _analysis_worker
+    if _analysis_worker is not None:
+        _analysis_worker.shutdown()
+        _analysis_worker = None
+
+# Lanes for count notes in time order. Lanes are dealt from shuffled bags
+# holding every lane CHART_MAX_LANE_SPREAD times, so no lane ever gets
+# more than that many notes ahead of another, and all lanes are even
+# after each full bag. The same seed always gives the same lanes.
+def assign_lanes(count, seed=None):
+    bag = np.repeat(np.arange(len(DIRECTIONS), dtype=np.int8), CHART_MAX_LANE_SPREAD)
+    bags = -(-count // len(bag))
+    rng = np.random.default_rng(seed)
+    return rng.permuted(np.tile(bag, (bags, 1)), axis=1).ravel()[:count]
+
+# Generate arrows based on beats
+def generate_arrows(beat_times, seed=None):
+    beat_times = np.sort(np.asarray(beat_times, dtype=np.float64))
+    return NoteChart(beat_times, assign_lanes(len(beat_times), seed))
+
+# Indices of the onsets kept for a difficulty tier: those at least as
+# strong as the `keep` share of strongest onsets, then, going forward in
+# time, the next kept onset at least `spacing` seconds after the last one
+def thin_onsets(times, strengths, keep, spacing):
+    selected = np.arange(len(times))
+    if keep < 1 and len(times):
+        selected = np.flatnonzero(strengths >= np.quantile(strengths, 1 - keep))
+    if spacing > 0 and len(selected):
+        kept_times = times[selected]
+        following = np.searchsorted(kept_times, kept_times + spacing, side='left').tolist()
+        chain = []
+        i = 0
+        while i < len(following):
+            chain.append(i)
+            i = following[i]
+        selected = selected[chain]
+    return selected
+
+# Onsets found by the analysis: their times in seconds, how strong each
+# one is and, for multi-band profiles, the lane of each. Charts for each
+# difficulty are made from it on demand; the thinned onsets of every tier
+# and the charts of seeded runs are kept for reuse.
+class Beatmap:
+    def __init__(self, times, strengths=None, lanes=None):
+        times = np.asarray(times, dtype=np.float64)
+        order = np.argsort(times, kind='stable')
+        self.times = times[order]
+        self.strengths = np.ones(len(times)) if strengths is None else np.asarray(strengths, dtype=np.float64)[order]
+        self.lanes = None if lanes is None else np.asarray(lanes, dtype=np.int8)[order]   # Lanes from the frequency bands, if analyzed
+        self.tiers = {}     # Difficulty -> indices of the onsets played
+        self.charts = {}    # Difficulty -> (seed, times, lanes) of the last seeded chart
+    
+    def __len__(self):
+        return len(self.times)
+    
+    def thin(self, difficulty):
+        if difficulty not in self.tiers:
+            self.tiers[difficulty] = thin_onsets(self.times, self.strengths, *DIFFICULTIES[difficulty])
+        return self.tiers[difficulty]
+    
+    # A fresh chart for a difficulty (default: DIFFICULTY). Unseeded charts
+    # are random and not kept; of the seeded ones only the last per
+    # difficulty is, so replaying with new seeds doesn't add up.
+    def chart(self, difficulty=None, seed=None):
+        difficulty = difficulty or DIFFICULTY
+        cached = self.charts.get(difficulty)
+        if seed is not None and cached and cached[0] == seed:
+            notes = cached[1:]
+        else:
+            played = self.thin(difficulty)
+            lanes = assign_lanes(len(played), seed) if self.lanes is None else self.lanes[played]
+            notes = (self.times[played], lanes)
+            if seed is not None:
+                self.charts[difficulty] = (seed, *notes)
+        return NoteChart(*notes)
+
+# All arrows of a song stored as parallel NumPy arrays sorted by beat time.
+# Lane colours and geometry live in the LANE_* tables, so a note is just a
+# row in these arrays. A visible window [first_visible, next_spawn) moves
+# forward with the song; per-frame positions and misses are computed on
+# that slice, and a key press bisects the per-lane beat times.
+class NoteChart:
+    def __init__(self, beat_times, lanes):
+        beat_times = np.asarray(beat_times, dtype=np.float64)
+        order = np.argsort(beat_times, kind='stable')
+        self.times = beat_times[order]
+        self.lanes = np.asarray(lanes, dtype=np.int8)[order]
+        self.state = np.full(len(self.times), NOTE_PENDING, dtype=np.int8)
+        self.hit_time = np.zeros(len(self.times), dtype=np.float64)      # Song time of the hit
+        self.judgement = np.full(len(self.times), JUDGE_NONE, dtype=np.int8)
+        self.y = np.zeros(0)                                             # Positions of the visible window
+        
+        # Indices and beat times of each lane's notes, for bisecting key presses
+        self.lane_notes = [np.flatnonzero(self.lanes == lane) for lane in range(len(DIRECTIONS))]
+        self.lane_times = [self.times[notes] for notes in self.lane_notes]
+        self.lane_heads = [0] * len(DIRECTIONS)   # First note per lane that may still be hit
+        
+        self.first_visible = 0  # First note that is still pending or showing its hit animation
+        self.next_spawn = 0     # First note that hasn't appeared yet
+        self.remaining = len(self.times)
+        self.end_time = float(self.times[-1]) if len(self.times) else 0.0
+    
+    def __len__(self):
+        return len(self.times)
+    
+    def visible(self):
+        return slice(self.first_visible, self.next_spawn)
+    
+    # Move visible arrows, spawn new ones and detect misses; returns the number of new misses
+    def update(self, song_time):
+        self.next_spawn = int(np.searchsorted(self.times, song_time + ARROW_LEAD_TIME, side='right'))
         
-        # Get onset frames (when there's a note/beat)
-        onset_env = librosa.onset.onset_strength(y=y, sr=sr)
-        onset_frames = librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr)
+        # Drop finished notes from the front of the window
+        state = self.state
+        while self.first_visible < self.next_spawn:
+            note_state = state[self.first_visible]
+            if note_state == NOTE_MISS or (note_state == NOTE_HIT and song_time - self.hit_time[self.first_visible] >= HIT_EFFECT_DURATION):
+                self.first_visible += 1
+            else:
+                break
         
-        # Convert frames to time (in seconds)
-        onset_times = librosa.frames_to_time(onset_frames, sr=sr)
+        window = self.visible()
+        self.y = HIT_LINE_Y - (self.times[window] - song_time) * SCROLL_SPEED
+        missed = (state[window] == NOTE_PENDING) & (song_time - self.times[window] > GOOD_THRESHOLD / 1000)
+        misses = int(np.count_nonzero(missed))
+        if misses:
+            state[window][missed] = NOTE_MISS
+            self.remaining -= misses
+        return misses
+    
+    # Closest pending note in a lane within window seconds of press_time,
+    # as (note, press_time - beat_time)
+    def find_hit(self, lane, press_time, window):
+        notes = self.lane_notes[lane]
+        times = self.lane_times[lane]
         
-        print(f"Detected {len(onset_times)} beats")
-        return onset_times
-    except Exception as e:
-        print(f"Error analyzing music: {e}")
-        # Return some dummy beats for testing if music analysis fails
-        return np.linspace(1, 60, 30)  # 30 beats over 60 seconds
+        # Skip past notes that are already resolved
+        head = self.lane_heads[lane]
+        while head < len(notes) and self.state[notes[head]] != NOTE_PENDING:
+            head += 1
+        self.lane_heads[lane] = head
+        
+        start = bisect.bisect_left(times, press_time - window, head)
+        end = bisect.bisect_right(times, press_time + window, start)
+        best = None
+        for i in range(start, end):
+            note = notes[i]
+            if self.state[note] == NOTE_PENDING:
+                error = float(press_time - times[i])
+                if best is None or abs(error) < abs(best[1]):
+                    best = (int(note), error)
+        return best
+    
+    # Record a hit on a note
+    def hit(self, note, judgement, song_time):
+        self.state[note] = NOTE_HIT
+        self.judgement[note] = judgement
+        self.hit_time[note] = song_time
+        self.remaining -= 1
+    
+    def is_finished(self, song_time):
+        return self.remaining == 0 and song_time > self.end_time + 5
+    
+    # Identifies the notes and lanes, to check a rebuilt chart is the same
+    def content_hash(self):
+        digest = hashlib.sha1(self.times.astype('<f8').tobytes())
+        digest.update(self.lanes.tobytes())
+        return digest.hexdigest()
+    
+    # Number of perfect, good and missed notes so far
+    def judgement_counts(self):
+        return {
+            'perfect': int(np.count_nonzero(self.judgement == JUDGE_PERFECT)),
+            'good': int(np.count_nonzero(self.judgement == JUDGE_GOOD)),
+            'miss': int(np.count_nonzero(self.state == NOTE_MISS)),
+        }
 
-# Generate arrows based on beats
-def generate_arrows(beat_times):
-    arrows = []
-    directions = ['left', 'up', 'down', 'right']
-    
-    # Ensure balanced distribution of directions
-    direction_counts = {d: 0 for d in directions}
-    
-    for beat_time in beat_times:
-        # Try to balance directions
-        if max(direction_counts.values()) > min(direction_counts.values()) + 3:
-            # Choose one of the least used directions
-            min_count = min(direction_counts.values())
-            least_used = [d for d in directions if direction_counts[d] == min_count]
-            direction = random.choice(least_used)
+# Scores lane key presses against a chart. These are the judgement rules
+# of the game without any drawing, so replays can be judged again offline.
+class Judge:
+    def __init__(self, chart, perfect_ms=PERFECT_THRESHOLD, good_ms=GOOD_THRESHOLD, timing=None):
+        self.chart = chart
+        self.timing = timing    # TimingStats collecting the error of every hit
+        self.perfect_window = perfect_ms / 1000
+        self.good_window = good_ms / 1000
+        self.score = 0
+        self.combo = 0
+        self.max_combo = 0
+        self.song_time = -np.inf    # Latest time the chart was moved to
+    
+    # Move the chart to a song time; misses break the combo
+    def advance(self, song_time):
+        self.song_time = max(self.song_time, song_time)
+        if self.chart.update(song_time):
+            self.combo = 0
+    
+    # Judge a press at a song time; returns JUDGE_NONE if no note was in reach
+    def press(self, lane, press_time):
+        # Notes that passed before the press are missed first, so the
+        # outcome only depends on the press times and not the frame rate
+        self.advance(press_time)
+        
+        # Check if any arrows can be hit - prioritize arrows closest to the beat
+        candidate = self.chart.find_hit(lane, press_time, self.good_window)
+        if not candidate:
+            return JUDGE_NONE
+        note, error = candidate
+        if abs(error) <= self.perfect_window:
+            judgement, points = JUDGE_PERFECT, 100
         else:
-            direction = random.choice(directions)
-            
-        direction_counts[direction] += 1
-        arrows.append(Arrow(direction, beat_time))
+            judgement, points = JUDGE_GOOD, 50
+        self.chart.hit(note, judgement, press_time)
+        if self.timing is not None:
+            self.timing.add(error)
+        self.score += points
+        self.combo += 1
+        if self.combo > self.max_combo:
+            self.max_combo = self.combo
+        return judgement
+
+# Signed timing error of each hit (press minus beat time in seconds, so
+# early hits are negative) in a preallocated ring buffer, cheap enough
+# to fill while playing
+class TimingStats:
+    def __init__(self, size=TIMING_HISTORY):
+        self.buffer = np.zeros(size, dtype=np.float32)
+        self.count = 0      # Hits added, including overwritten ones
+    
+    def __len__(self):
+        return min(self.count, len(self.buffer))
+    
+    def add(self, error):
+        self.buffer[self.count % len(self.buffer)] = error
+        self.count += 1
+    
+    # The kept errors, oldest first
+    def errors(self):
+        if self.count <= len(self.buffer):
+            return self.buffer[:self.count]
+        return np.roll(self.buffer, -(self.count % len(self.buffer)))
+    
+    # Mean, standard deviation and median in milliseconds, and early/late counts
+    def summary(self):
+        errors = self.errors() * 1000
+        if not len(errors):
+            return {'hits': 0}
+        return {
+            'hits': len(errors),
+            'mean_ms': float(errors.mean()),
+            'std_ms': float(errors.std()),
+            'median_ms': float(np.median(errors)),
+            'early': int(np.count_nonzero(errors < 0)),
+            'late': int(np.count_nonzero(errors > 0)),
+        }
     
-    return arrows
+    # Hit counts in equal bins across the good window; returns (counts, edges in ms)
+    def histogram(self, bins=TIMING_HISTOGRAM_BINS):
+        return np.histogram(self.errors() * 1000, bins=bins, range=(-GOOD_THRESHOLD, GOOD_THRESHOLD))
+    
+    def export(self, path, **meta):
+        counts, edges = self.histogram()
+        data = dict(meta, summary=self.summary(),
+                    histogram={'counts': counts.tolist(), 'edges_ms': edges.tolist()},
+                    errors_ms=[round(float(e), 3) for e in self.errors() * 1000])
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+
+# Draw a timing histogram in rect, with the perfect window and the beat marked
+def draw_timing_histogram(surface, rect, timing):
+    counts, _ = timing.histogram()
+    pygame.draw.rect(surface, DARK_GRAY, rect)
+    bar_width = rect.width / len(counts)
+    perfect_left = rect.centerx - rect.width * PERFECT_THRESHOLD / (2 * GOOD_THRESHOLD)
+    perfect_right = rect.centerx + rect.width * PERFECT_THRESHOLD / (2 * GOOD_THRESHOLD)
+    tallest = counts.max() or 1
+    for i, count in enumerate(counts):
+        x = rect.x + i * bar_width
+        height = int((rect.height - 4) * count / tallest)
+        color = CYAN if perfect_left <= x + bar_width / 2 <= perfect_right else GREEN
+        pygame.draw.rect(surface, color, (int(x) + 1, rect.bottom - height, max(1, int(bar_width) - 1), height))
+    pygame.draw.line(surface, WHITE, (rect.centerx, rect.y), (rect.centerx, rect.bottom - 1))
+    pygame.draw.rect(surface, GRAY, rect, 1)
+
+# Sprites for arrows, targets and hit effects, drawn once and converted to
+# the display format so each frame only blits them
+class SpriteAtlas:
+    def __init__(self):
+        self.arrows = []
+        self.targets = []
+        self.pressed_targets = []
+        self.hit_circles = []     # Per lane: expanding, fading circle frames
+        for lane in range(len(DIRECTIONS)):
+            self.arrows.append(self.make_arrow(lane))
+            self.targets.append(self.make_target(lane, pressed=False))
+            self.pressed_targets.append(self.make_target(lane, pressed=True))
+            self.hit_circles.append([self.make_hit_circle(lane, frame) for frame in range(HIT_EFFECT_FRAMES)])
+        
+        # Fading judgement text frames
+        self.hit_texts = {
+            JUDGE_PERFECT: self.make_fading_text("PERFECT!", CYAN),
+            JUDGE_GOOD: self.make_fading_text("GOOD!", GREEN),
+        }
+    
+    def make_arrow(self, lane):
+        sprite = pygame.Surface((ARROW_SIZE, ARROW_SIZE))
+        profiler.count('surfaces')
+        sprite.fill(LANE_COLORS[lane])
+        
+        # Draw arrow direction indicator with an outline for better visibility
+        pygame.draw.polygon(sprite, WHITE, ARROW_POINTS[lane])
+        pygame.draw.polygon(sprite, BLACK, ARROW_POINTS[lane], 2)
+        return display_format(sprite)
+    
+    def make_target(self, lane, pressed):
+        sprite = pygame.Surface((ARROW_SIZE, ARROW_SIZE), pygame.SRCALPHA)
+        profiler.count('surfaces')
+        if pressed:
+            pygame.draw.rect(sprite, LANE_LIGHT_COLORS[lane], sprite.get_rect())
+        else:
+            pygame.draw.rect(sprite, LANE_COLORS[lane], sprite.get_rect(), 2)
+        pygame.draw.polygon(sprite, WHITE, TARGET_POINTS[lane])
+        pygame.draw.polygon(sprite, BLACK, TARGET_POINTS[lane], 2)
+        return display_format(sprite, alpha=True)
+    
+    def make_hit_circle(self, lane, frame):
+        progress = frame / HIT_EFFECT_FRAMES
+        alpha = max(0, 255 - int(255 * progress))
+        radius = int(30 * progress) + 20
+        sprite = pygame.Surface((HIT_EFFECT_SIZE, HIT_EFFECT_SIZE), pygame.SRCALPHA)
+        profiler.count('surfaces')
+        pygame.draw.circle(sprite, (*LANE_COLORS[lane], alpha), (HIT_EFFECT_SIZE // 2, HIT_EFFECT_SIZE // 2), radius)
+        return display_format(sprite, alpha=True)
+    
+    def make_fading_text(self, text, color):
+        frames = []
+        base = display_format(get_font(28).render(text, True, color), alpha=True)
+        for frame in range(HIT_EFFECT_FRAMES):
+            alpha = max(0, 255 - int(255 * frame / HIT_EFFECT_FRAMES))
+            sprite = base.copy()
+            profiler.count('surfaces')
+            sprite.fill((255, 255, 255, alpha), special_flags=pygame.BLEND_RGBA_MULT)
+            frames.append(sprite)
+        return frames
+
+_sprite_atlas = None
+
+# The sprite atlas is built on first use, after the display exists
+def get_sprite_atlas():
+    global _sprite_atlas
+    if _sprite_atlas is None:
+        _sprite_atlas = SpriteAtlas()
+    return _sprite_atlas
+
+# Draw the visible arrows and hit animations of a chart
+# (returns the drawn rects when doreturn is set)
+def draw_notes(surface, chart, song_time, doreturn=False):
+    atlas = get_sprite_atlas()
+    window = chart.visible()
+    blits = []
+    for offset, note in enumerate(range(window.start, window.stop)):
+        lane = chart.lanes[note]
+        x = LANE_X[lane]
+        state = chart.state[note]
+        
+        if state == NOTE_PENDING:
+            blits.append((atlas.arrows[lane], (x, chart.y[offset])))
+            
+        elif state == NOTE_HIT and song_time - chart.hit_time[note] < HIT_EFFECT_DURATION:
+            # Draw hit feedback animation
+            progress = max(0.0, song_time - chart.hit_time[note]) / HIT_EFFECT_DURATION
+            frame = min(HIT_EFFECT_FRAMES - 1, int(progress * HIT_EFFECT_FRAMES))
+            circle_offset = (HIT_EFFECT_SIZE - ARROW_SIZE) // 2
+            blits.append((atlas.hit_texts[chart.judgement[note]][frame], (x, HIT_LINE_Y - 30)))
+            blits.append((atlas.hit_circles[lane][frame], (x - circle_offset, HIT_LINE_Y - circle_offset)))
+    profiler.count('blits', len(blits))
+    return surface.blits(blits, doreturn=doreturn)
 
 # Draw the arrow targets at the bottom
-def draw_targets(active_key=None):
+HIT_LINE_RECT = pygame.Rect(150, HIT_LINE_Y - 1, 501, 3)
+
+def draw_targets(active_key=None, surface=None):
+    surface = surface or screen
+    
     # Draw hit line
-    pygame.draw.line(screen, WHITE, (150, HIT_LINE_Y), (650, HIT_LINE_Y), 3)
+    surface.fill(WHITE, HIT_LINE_RECT)
     
     # Draw targets with active highlighting
-    left_color = LIGHT_BLUE if active_key == 'left' else BLUE
-    up_color = LIGHT_GREEN if active_key == 'up' else GREEN
-    down_color = LIGHT_RED if active_key == 'down' else RED
-    right_color = LIGHT_YELLOW if active_key == 'right' else YELLOW
+    atlas = get_sprite_atlas()
+    for lane, direction in enumerate(DIRECTIONS):
+        sprite = atlas.pressed_targets[lane] if active_key == direction else atlas.targets[lane]
+        surface.blit(sprite, (LANE_X[lane], HIT_LINE_Y))
+    profiler.count('blits', len(DIRECTIONS))
+
+# Area covered by the hit line and targets
+TARGETS_RECT = pygame.Rect(150, HIT_LINE_Y - 2, 500, ARROW_SIZE + 3)
+
+# Draws the gameplay screen, either redrawing and flipping the whole
+# window each frame or, in dirty-rect mode, restoring a cached static
+# background under what moved and pushing only those rects to the display.
+# With the texture backend every frame is drawn in full on its canvas.
+class GameplayRenderer:
+    def __init__(self, song_name, dirty_rects=None):
+        self.song_name = song_name
+        self.dirty_rects = DIRTY_RECT_RENDERING if dirty_rects is None else dirty_rects
+        self.canvas = texture_display.canvas if texture_display else screen
+        if texture_display:
+            self.dirty_rects = False
+        
+        # Static layer: hit line, target outlines and song title
+        self.background = display_format(pygame.Surface((WIDTH, HEIGHT)))
+        profiler.count('surfaces')
+        self.background.fill(BLACK)
+        draw_targets(None, self.background)
+        song_display = render_text(f"Song: {song_name}", 24, CYAN)
+        self.background.blit(song_display, (WIDTH - song_display.get_width() - 20, 20))
+        
+        self.reset()
+    
+    # Forget what is on screen so the next frame is drawn in full
+    def reset(self):
+        self.full_redraw = True
+        self.previous_rects = []    # Moving content drawn last frame
+        self.update_rects = None    # None means the whole window
+        self.hud_text = {}          # Position -> (text, rect) currently on screen
+        self.active_key = None
+    
+    def toggle_dirty_rects(self):
+        if texture_display:
+            return
+        self.dirty_rects = not self.dirty_rects
+        self.reset()
+        
+    def draw(self, chart, song_time, active_key, score, combo):
+        hud = [((20, 20), f"Score: {score}"), ((20, 60), f"Combo: {combo}")]
+        if not self.dirty_rects:
+            canvas = self.canvas
+            canvas.blit(self.background, (0, 0))
+            draw_notes(canvas, chart, song_time)
+            draw_targets(active_key, canvas)
+            for pos, text in hud:
+                canvas.blit(render_text(text, 36, WHITE), pos)
+            profiler.count('blits', 1 + len(hud))
+            self.update_rects = None
+            return
+        
+        full_redraw = self.full_redraw
+        self.full_redraw = False
+        if full_redraw:
+            screen.blit(self.background, (0, 0))
+        
+        # Restore the background under last frame's notes
+        for rect in self.previous_rects:
+            screen.blit(self.background, rect, rect)
+        profiler.count('blits', len(self.previous_rects) + full_redraw)
+        note_rects = draw_notes(screen, chart, song_time, doreturn=True)
+        dirty = self.previous_rects + note_rects
+        
+        # Targets are drawn over the notes, so redraw them when anything near them changed
+        targets_dirty = full_redraw or active_key != self.active_key or TARGETS_RECT.collidelist(dirty) != -1
+        if targets_dirty:
+            draw_targets(active_key)
+            dirty.append(TARGETS_RECT)
+        self.active_key = active_key
+        
+        # Redraw HUD text only when it changes
+        for pos, text in hud:
+            shown = self.hud_text.get(pos)
+            if not full_redraw and shown and shown[0] == text and shown[1].collidelist(note_rects) == -1:
+                continue
+            if shown:
+                screen.blit(self.background, shown[1], shown[1])
+                dirty.append(shown[1])
+            rect = screen.blit(render_text(text, 36, WHITE), pos)
+            profiler.count('blits', 1 + bool(shown))
+            self.hud_text[pos] = (text, rect)
+            dirty.append(rect)
+        
+        self.previous_rects = note_rects
+        self.update_rects = None if full_redraw else dirty
+    
+    # Also push a rect drawn over the frame by someone else (the profiler overlay)
+    def mark_dirty(self, rect):
+        if texture_display:
+            texture_display.copy_area(screen, rect)
+        elif self.update_rects is not None:
+            self.update_rects.append(rect)
+    
+    # Push the frame to the display
+    def present(self):
+        if texture_display:
+            texture_display.present()
+        elif self.update_rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.update_rects)
+            self.update_rects = []
+
+# Draws on an SDL2 renderer with the blit/blits/fill calls of a Surface,
+# so the note, target and HUD drawing code works on either. Each sprite is
+# uploaded as a texture the first time it is drawn and copied after that;
+# the texture goes away with its sprite.
+class TextureCanvas:
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.textures = weakref.WeakKeyDictionary()
+    
+    def texture(self, sprite):
+        texture = self.textures.get(sprite)
+        if texture is None:
+            texture = pygame._sdl2.video.Texture.from_surface(self.renderer, sprite)
+            profiler.count('textures')
+            self.textures[sprite] = texture
+        return texture
+    
+    def blit(self, sprite, pos):
+        rect = pygame.Rect(pos, sprite.get_size())
+        self.texture(sprite).draw(dstrect=rect)
+        return rect
+    
+    def blits(self, blit_sequence, doreturn=True):
+        rects = [self.blit(sprite, pos) for sprite, pos in blit_sequence]
+        return rects if doreturn else None
+    
+    def fill(self, color, rect=None):
+        self.renderer.draw_color = pygame.Color(color)
+        if rect is None:
+            self.renderer.clear()
+        else:
+            self.renderer.fill_rect(rect)
+
+# The window as an SDL2 renderer, with vsync if enabled. The gameplay screen draws on
+# its canvas; other scenes draw on `screen` as usual and it is uploaded
+# through one streaming texture to be shown.
+class TextureDisplay:
+    def __init__(self, title):
+        video = importlib.import_module('pygame._sdl2.video')
+        self.window = video.Window(title, size=(WIDTH, HEIGHT))
+        self.vsync = RENDER_VSYNC
+        self.renderer = video.Renderer(self.window, vsync=self.vsync)
+        self.canvas = TextureCanvas(self.renderer)
+        self.frame = video.Texture(self.renderer, (WIDTH, HEIGHT), streaming=True)
+    
+    def present_surface(self, surface):
+        self.frame.update(surface)
+        self.frame.draw()
+        self.renderer.present()
+    
+    # Show part of a surface over what was drawn on the canvas
+    def copy_area(self, surface, rect):
+        rect = rect.clip(surface.get_rect())
+        self.frame.update(surface.subsurface(rect), rect)
+        self.frame.draw(srcrect=rect, dstrect=rect)
     
-    # Draw targets
-    pygame.draw.rect(screen, left_color, (200, HIT_LINE_Y, 50, 50), 0 if active_key == 'left' else 2)
-    pygame.draw.rect(screen, up_color, (300, HIT_LINE_Y, 50, 50), 0 if active_key == 'up' else 2)
-    pygame.draw.rect(screen, down_color, (400, HIT_LINE_Y, 50, 50), 0 if active_key == 'down' else 2)
-    pygame.draw.rect(screen, right_color, (500, HIT_LINE_Y, 50, 50), 0 if active_key == 'right' else 2)
+    def present(self):
+        self.renderer.present()
+
+# Where the frame time goes: the SceneManager marks the end of each phase
+# of a frame and drawing code counts what it did. Keeps the last
+# PROFILER_HISTORY frames for the F3 overlay and the periodic log, and
+# every phase as a Chrome trace event (chrome://tracing, Perfetto) while tracing.
+class FrameProfiler:
+    PHASES = ('events', 'update', 'draw', 'flip', 'wait')
+    
+    def __init__(self, history=PROFILER_HISTORY):
+        self.show = False           # Draw the overlay
+        self.log = False            # Print a summary every PROFILER_LOG_INTERVAL seconds
+        self.trace_events = None    # Chrome trace events, None when not tracing
+        self.frame_times = deque(maxlen=history)
+        self.phase_times = {phase: deque(maxlen=history) for phase in self.PHASES}
+        self.counters = {}          # Counts of the frame in progress
+        self.last_counters = {}     # Counts of the last finished frame
+        self.frame_start = self.mark_time = time.perf_counter()
+        self.hud = None
+        self.hud_time = 0
+        self.log_time = time.perf_counter()
+    
+    def start_trace(self):
+        self.trace_events = []
+    
+    def write_trace(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
+        print(f"Trace of {len(self.trace_events)} events written to {path}")
+    
+    def begin_frame(self):
+        self.frame_start = self.mark_time = time.perf_counter()
+        self.counters = {}
+    
+    # End the current phase of the frame
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phase_times[phase].append(now - self.mark_time)
+        if self.trace_events is not None:
+            self.trace_events.append({
+                'name': phase, 'ph': 'X', 'pid': 1, 'tid': 1,
+                'ts': (self.mark_time - STARTUP_COUNTER) * 1e6, 'dur': (now - self.mark_time) * 1e6,
+            })
+        self.mark_time = now
+    
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
     
-    # Draw direction indicators in targets with better visibility
-    pygame.draw.polygon(screen, WHITE, [(235, HIT_LINE_Y + 10), (235, HIT_LINE_Y + 40), (215, HIT_LINE_Y + 25)])
-    pygame.draw.polygon(screen, BLACK, [(235, HIT_LINE_Y + 10), (235, HIT_LINE_Y + 40), (215, HIT_LINE_Y + 25)], 2)
+    def end_frame(self):
+        now = time.perf_counter()
+        self.frame_times.append(now - self.frame_start)
+        self.last_counters = self.counters
+        if self.trace_events is not None:
+            self.trace_events.append({
+                'name': 'counters', 'ph': 'C', 'pid': 1, 'tid': 1,
+                'ts': (now - STARTUP_COUNTER) * 1e6, 'args': dict(self.counters),
+            })
+        if self.log and now - self.log_time >= PROFILER_LOG_INTERVAL:
+            self.log_time = now
+            print(self.summary())
     
-    pygame.draw.polygon(screen, WHITE, [(310, HIT_LINE_Y + 35), (340, HIT_LINE_Y + 35), (325, HIT_LINE_Y + 15)])
-    pygame.draw.polygon(screen, BLACK, [(310, HIT_LINE_Y + 35), (340, HIT_LINE_Y + 35), (325, HIT_LINE_Y + 15)], 2)
+    # FPS, mean and 99th percentile frame time, and mean time per phase (ms)
+    def stats(self):
+        frame_times = sorted(self.frame_times)
+        if not frame_times:
+            return 0.0, 0.0, 0.0, {phase: 0.0 for phase in self.PHASES}
+        fps = len(frame_times) / sum(frame_times)
+        mean = sum(frame_times) / len(frame_times) * 1000
+        p99 = frame_times[int(0.99 * (len(frame_times) - 1))] * 1000
+        phases = {phase: sum(times) / len(times) * 1000 if times else 0.0 for phase, times in self.phase_times.items()}
+        return fps, mean, p99, phases
     
-    pygame.draw.polygon(screen, WHITE, [(410, HIT_LINE_Y + 15), (440, HIT_LINE_Y + 15), (425, HIT_LINE_Y + 35)])
-    pygame.draw.polygon(screen, BLACK, [(410, HIT_LINE_Y + 15), (440, HIT_LINE_Y + 15), (425, HIT_LINE_Y + 35)], 2)
+    def summary(self):
+        fps, mean, p99, phases = self.stats()
+        counters = ", ".join(f"{name} {value}" for name, value in sorted(self.last_counters.items()))
+        return (f"{fps:.1f} FPS, frame {mean:.2f} ms (p99 {p99:.2f} ms); "
+                + ", ".join(f"{phase} {ms:.2f}" for phase, ms in phases.items())
+                + (f" ms; {counters}" if counters else " ms"))
     
-    pygame.draw.polygon(screen, WHITE, [(515, HIT_LINE_Y + 10), (515, HIT_LINE_Y + 40), (535, HIT_LINE_Y + 25)])
-    pygame.draw.polygon(screen, BLACK, [(515, HIT_LINE_Y + 10), (515, HIT_LINE_Y + 40), (535, HIT_LINE_Y + 25)], 2)
+    # Frame counts per PROFILER_HISTOGRAM_BIN_MS bin, longer frames in the last bin
+    def histogram(self):
+        bins = [0] * PROFILER_HISTOGRAM_BINS
+        for frame_time in self.frame_times:
+            bins[min(PROFILER_HISTOGRAM_BINS - 1, int(frame_time * 1000 / PROFILER_HISTOGRAM_BIN_MS))] += 1
+        return bins
+    
+    # Draw the overlay, re-rendering its contents a few times a second; returns its rect
+    def draw(self, surface):
+        now = time.perf_counter()
+        if self.hud is None or now - self.hud_time >= PROFILER_HUD_REFRESH:
+            self.hud = self.render_hud()
+            self.hud_time = now
+        return surface.blit(self.hud, PROFILER_HUD_POS)
+    
+    def render_hud(self):
+        fps, mean, p99, phases = self.stats()
+        counters = self.last_counters
+        lines = [
+            f"{fps:5.1f} FPS   p99 {p99:5.2f} ms",
+            f"events {phases['events']:.2f}  update {phases['update']:.2f}",
+            f"draw {phases['draw']:.2f}  flip {phases['flip']:.2f}",
+            f"wait {phases['wait']:.2f} ms",
+            f"notes {counters.get('notes', 0)}  blits {counters.get('blits', 0)}",
+            f"new surfaces {counters.get('surfaces', 0)}",
+        ]
+        font = get_font(20)
+        line_height = 18
+        width = 210
+        hud = display_format(pygame.Surface((width, line_height * len(lines) + 60)))
+        hud.fill((20, 20, 20))
+        for i, line in enumerate(lines):
+            hud.blit(font.render(line, True, WHITE), (8, 6 + line_height * i))
+        
+        # Frame time histogram with the frame budget marked
+        bins = self.histogram()
+        top = line_height * len(lines) + 12
+        bar_width = (width - 16) // PROFILER_HISTOGRAM_BINS
+        tallest = max(bins) or 1
+        for i, count in enumerate(bins):
+            height = 40 * count // tallest
+            pygame.draw.rect(hud, GREEN if i * PROFILER_HISTOGRAM_BIN_MS < 1000 / FPS else RED,
+                             (8 + i * bar_width, top + 40 - height, bar_width - 1, height))
+        budget_x = 8 + int(1000 / FPS / PROFILER_HISTOGRAM_BIN_MS * bar_width)
+        pygame.draw.line(hud, YELLOW, (budget_x, top), (budget_x, top + 40))
+        pygame.draw.rect(hud, GRAY, hud.get_rect(), 1)
+        return hud
+
+profiler = FrameProfiler()
 
 # Display hit feedback text
 def display_hit_text(hit_type, x, y):
-    font = pygame.font.SysFont(None, 36)
     if hit_type == "perfect":
-        text = font.render("PERFECT!", True, CYAN)
+        text = render_text("PERFECT!", 36, CYAN)
     elif hit_type == "good":
-        text = font.render("GOOD!", True, GREEN)
+        text = render_text("GOOD!", 36, GREEN)
     else:
-        text = font.render("MISS!", True, RED)
+        text = render_text("MISS!", 36, RED)
     
     screen.blit(text, (x, y))
 
-# Main game function
-def main():
-    # Create a main menu first
-    show_main_menu = True
-    
-    while show_main_menu:
-        # Main menu
-        screen.fill(BLACK)
-        font = pygame.font.SysFont(None, 64)
-        title = font.render("Heat the beat", True, WHITE)
+# Runs in a worker process: bring one library track's beatmap up to date.
+# With decode_audio the track is also decoded into the PCM cache (timed
+# separately), so the mixer doesn't decode it while playing; that cache
+# is capped, so it is only filled on request.
+def _analyze_library_file(music_path, force, profile, decode_audio=False):
+    start = time.perf_counter()
+    decode_seconds = 0.0
+    try:
+        content_hash = music_content_hash(music_path)
+        params = analysis_params(profile)
+        audio = None
+        if decode_audio:
+            audio = load_decoded_audio(music_path, content_hash)
+            decode_seconds = time.perf_counter() - start
+        if not force:
+            beatmap = load_beatmap(content_hash, params)
+            if beatmap is not None:
+                return music_path, 'cached', len(beatmap), 0.0, estimate_tempo(beatmap.times), time.perf_counter() - start - decode_seconds, decode_seconds
         
-        # Create menu buttons
-        play_button = Button(WIDTH//2 - 150, HEIGHT//2 - 70, 300, 60, "Play", GREEN, LIGHT_GREEN)
-        quit_button = Button(WIDTH//2 - 150, HEIGHT//2 + 10, 300, 60, "Quit", RED, LIGHT_RED)
+        beatmap = detect_onsets(music_path, profile=profile, audio=audio)
+        save_beatmap(content_hash, params, beatmap)
+        duration = librosa.get_duration(path=music_path)
+        return music_path, 'analyzed', len(beatmap), duration, estimate_tempo(beatmap.times), time.perf_counter() - start - decode_seconds, decode_seconds
+    except Exception as e:
+        print(f"Error analyzing {music_path}: {e}")
+        return music_path, 'failed', 0, 0.0, None, time.perf_counter() - start - decode_seconds, decode_seconds
+
+# Analyze every track in a folder across all cores without opening a window
+def analyze_library(folder='assets', jobs=None, force=False, profile=None, decode_audio=False):
+    if not os.path.isdir(folder):
+        print(f"Music folder not found: {folder}")
+        return 1
+    library = SongLibrary(folder)
+    music_paths = [entry['path'] for entry in library.refresh()]
+    if not music_paths:
+        print(f"No music files found in {folder}")
+        return 0
+    
+    jobs = jobs or os.cpu_count() or 1
+    profile = profile or ANALYSIS_PROFILE
+    print(f"Analyzing {len(music_paths)} tracks with {jobs} processes ({profile} profile)")
+    
+    counts = {'analyzed': 0, 'cached': 0, 'failed': 0}
+    audio_seconds = 0.0
+    start = time.perf_counter()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+        futures = [executor.submit(_analyze_library_file, path, force, profile, decode_audio) for path in music_paths]
+        for future in as_completed(futures):
+            music_path, status, beats, duration, tempo, elapsed, decode_seconds = future.result()
+            counts[status] += 1
+            entry = library.entries[music_path]
+            entry['status'] = 'failed' if status == 'failed' else 'analyzed'
+            entry['tempo'] = tempo
+            entry['duration'] = duration or entry['duration']
+            library.changed = True
+            audio_seconds += duration
+            decoded = f"  decoded in {decode_seconds:.2f}s" if decode_audio else ""
+            if status == 'analyzed':
+                print(f"  {status:8} {elapsed:7.2f}s  {duration:7.1f}s audio  {beats:6} beats  {music_path}{decoded}")
+            else:
+                print(f"  {status:8} {elapsed:7.2f}s  {music_path}{decoded}")
+    
+    library.save()
+    
+    total = time.perf_counter() - start
+    print(f"Done in {total:.2f}s: {counts['analyzed']} analyzed, {counts['cached']} up to date, {counts['failed']} failed")
+    print(f"Throughput: {len(music_paths) / total:.2f} tracks/s, {audio_seconds / total:.1f}s of audio analyzed per second")
+    return 1 if counts['failed'] else 0
+
+# The mixer set up for low latency, with a few channels kept free for
+# hit sounds, which are loaded once and played on those channels only
+class AudioSystem:
+    def __init__(self):
+        self.sounds = {}
+        self.channels = []
+        self.next_channel = 0
+        self.latency = 0.0      # Seconds from mixing a sample to hearing it
+    
+    # Must come before pygame.init, which opens the mixer
+    def pre_init(self):
+        pygame.mixer.pre_init(MIXER_SAMPLE_RATE, -16, 2, MIXER_BUFFER)
+    
+    def start(self):
+        mixer_settings = pygame.mixer.get_init()
+        if not mixer_settings:
+            print("No audio output available")
+            return
+        frequency, _, _ = mixer_settings
+        pygame.mixer.set_num_channels(MIXER_CHANNELS)
+        pygame.mixer.set_reserved(HIT_SOUND_CHANNELS)
+        self.channels = [pygame.mixer.Channel(i) for i in range(HIT_SOUND_CHANNELS)]
+        self.next_channel = 0
         
-        # Draw menu
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, HEIGHT//4))
+        # A sample is heard once the buffer it was mixed into has been played
+        self.latency = MIXER_BUFFER / frequency
         
-        mouse_pos = pygame.mouse.get_pos()
-        mouse_click = False
+        # Sounds belong to the mixer they were loaded by, so reload them for a new one
+        self.sounds = {}
+        for name, path in HIT_SOUNDS.items():
+            try:
+                self.sounds[name] = pygame.mixer.Sound(path)
+            except (FileNotFoundError, pygame.error):
+                pass
+    
+    # Play a hit sound ('perfect' or 'good') on a free hit sound channel,
+    # cutting off the oldest one if they are all busy
+    def play_hit(self, name):
+        sound = self.sounds.get(name)
+        if sound is None or not self.channels:
+            return
+        for i in range(len(self.channels)):
+            index = (self.next_channel + i) % len(self.channels)
+            if not self.channels[index].get_busy():
+                break
+        else:
+            index = self.next_channel
+        self.channels[index].play(sound)
+        self.next_channel = (index + 1) % len(self.channels)
+    
+    def describe(self):
+        mixer_settings = pygame.mixer.get_init()
+        if not mixer_settings:
+            return "no audio output"
+        return f"{mixer_settings[0]} Hz, {MIXER_BUFFER}-sample buffer, {self.latency * 1000:.1f} ms output latency"
+
+_audio = None
+
+def get_audio():
+    global _audio
+    if _audio is None:
+        _audio = AudioSystem()
+    return _audio
+
+# Song time in seconds, driven by the music playback position.
+# pygame.mixer.music.get_pos only advances when the mixer fills a buffer,
+# so between updates the time is extrapolated with time.perf_counter and
+# each new mixer position nudges the clock towards the audio. The mixer
+# position runs ahead of what is heard by the output latency, which is
+# added to the audio offset.
+class SongClock:
+    def __init__(self, has_music=True, offset_ms=None):
+        self.has_music = has_music
+        self.offset = (AUDIO_OFFSET_MS if offset_ms is None else offset_ms) / 1000
+        if has_music:
+            self.offset += get_audio().latency
+        self.zero_counter = None    # perf_counter value at song time 0
+        self.music_playing = False
+        self.last_pos = -1
+        self.last_time = None
         
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                return  # Exit game
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    return  # Exit game
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                if event.button == 1:  # Left mouse button
-                    mouse_click = True
-        
-        # Update and draw buttons
-        play_button.update(mouse_pos)
-        play_button.draw(screen)
-        
-        quit_button.update(mouse_pos)
-        quit_button.draw(screen)
+    # Start counting; song time 0 (and the music) comes after lead_in seconds
+    def start(self, lead_in=0.0):
+        self.zero_counter = time.perf_counter() + lead_in
+        self.music_playing = False
+        self.last_pos = -1
+        self.last_time = None
+    
+    # Call once per frame: starts the music when due and corrects drift
+    def update(self):
+        now = time.perf_counter()
+        if not self.music_playing and now >= self.zero_counter:
+            if self.has_music:
+                pygame.mixer.music.play()
+                self.zero_counter = time.perf_counter()
+            self.music_playing = True
         
-        # Handle button clicks
-        if play_button.is_clicked(mouse_pos, mouse_click):
-            # Get selected song
-            music_path = load_assets()
-            
-            # If a song was selected, start the game
-            if music_path is not None or music_path == None:  # None is valid for default beat pattern
-                play_game(music_path)
-                
-        if quit_button.is_clicked(mouse_pos, mouse_click):
-            return  # Exit game
-            
-        pygame.display.flip()
-        clock.tick(FPS)
+        if self.music_playing and self.has_music:
+            pos = pygame.mixer.music.get_pos()
+            if pos >= 0 and pos != self.last_pos:
+                self.last_pos = pos
+                drift = pos / 1000 - (now - self.zero_counter)
+                if abs(drift) > CLOCK_RESYNC_THRESHOLD:
+                    self.zero_counter -= drift
+                else:
+                    self.zero_counter -= drift * CLOCK_DRIFT_CORRECTION
     
-    pygame.quit()
+    # Song time at a time.perf_counter value, e.g. when an input event arrived
+    def time_at(self, counter):
+        return counter - self.zero_counter - self.offset
+    
+    # Current song time (never goes backwards)
+    def time(self):
+        song_time = time.perf_counter() - self.zero_counter - self.offset
+        if self.last_time is not None and song_time < self.last_time:
+            song_time = self.last_time
+        self.last_time = song_time
+        return song_time
 
-# Play the actual rhythm game with the selected song
-def play_game(music_path):
-    # Analyze music to get beat times
-    beat_times = analyze_music(music_path if music_path else None)
+# Song time that only moves when advanced by a whole frame, for headless
+# simulations. Key presses are stamped with song time directly, so
+# time_at returns its argument.
+class VirtualClock:
+    def __init__(self, fps=FPS):
+        self.frame_time = 1.0 / fps
+        self.origin = 0.0
+        self.frame = 0
+        
+    def start(self, lead_in=0.0):
+        self.origin = -lead_in
+        self.frame = 0
     
-    # Generate arrows based on beat times
-    arrows = generate_arrows(beat_times)
+    def advance(self):
+        self.frame += 1
     
-    # Game variables
-    score = 0
-    combo = 0
-    max_combo = 0
-    active_key = None
-    key_press_time = 0
+    def update(self):
+        pass
     
-    start_time = time.time()
-    song_started = False
+    def time_at(self, song_time):
+        return song_time
     
-    # Sound effects for hits
-    try:
-        hit_sound = pygame.mixer.Sound('assets/hit.wav')
-        perfect_sound = pygame.mixer.Sound('assets/perfect.wav')
-    except:
-        # Create directory for sound effects if it doesn't exist
-        hit_sound = None
-        perfect_sound = None
-    
-    # Display song info
-    song_name = os.path.basename(music_path) if music_path else "Default Beat Pattern"
-    
-    # Load the music if available
-    if music_path:
-        pygame.mixer.music.load(music_path)
-    
-    running = True
-    
-    # Welcome screen
-    show_welcome = True
-    while show_welcome:
-        screen.fill(BLACK)
-        font = pygame.font.SysFont(None, 48)
-        title = font.render("Get Ready!", True, WHITE)
-        song_title = pygame.font.SysFont(None, 36)
-        song_text = song_title.render(f"Song: {song_name}", True, CYAN)
-        instructions = pygame.font.SysFont(None, 28)
-        inst_text1 = instructions.render("Press the arrow keys to hit the notes when they reach the white line", True, WHITE)
-        inst_text2 = instructions.render("Press SPACE to start", True, GREEN)
-        
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, HEIGHT//4))
-        screen.blit(song_text, (WIDTH//2 - song_text.get_width()//2, HEIGHT//4 + 60))
-        screen.blit(inst_text1, (WIDTH//2 - inst_text1.get_width()//2, HEIGHT//2))
-        screen.blit(inst_text2, (WIDTH//2 - inst_text2.get_width()//2, HEIGHT//2 + 50))
-        
-        pygame.display.flip()
+    def time(self):
+        return self.origin + self.frame * self.frame_time
+
+# Arrow keys and the lane they hit
+LANE_KEYS = {pygame.K_LEFT: 0, pygame.K_UP: 1, pygame.K_DOWN: 2, pygame.K_RIGHT: 3}
+
+# Reads input separately from rendering. Lane key presses are handed to
+# on_key together with the time.perf_counter value of the poll that read
+# them, and the frame loop waits for its next frame by polling every
+# INPUT_POLL_INTERVAL instead of sleeping, so a press is judged at most
+# about a millisecond after it happens rather than at the next frame.
+# Other events are kept for the frame loop.
+class InputPoller:
+    def __init__(self, on_key, on_release=None):
+        self.on_key = on_key
+        self.on_release = on_release
+        self.pending = []
         
+    def poll(self):
+        counter = time.perf_counter()
         for event in pygame.event.get():
-            if event.type == pygame.QUIT:
+            if event.type == pygame.KEYDOWN and event.key in LANE_KEYS:
+                self.on_key(LANE_KEYS[event.key], counter)
+            elif event.type == pygame.KEYUP and event.key in LANE_KEYS and self.on_release:
+                self.on_release(LANE_KEYS[event.key], counter)
+            else:
+                self.pending.append(event)
+    
+    # Non-lane events since the last call
+    def events(self):
+        self.poll()
+        events = self.pending
+        self.pending = []
+        return events
+    
+    # Keep polling until the perf_counter deadline
+    def wait_until(self, deadline):
+        while True:
+            self.poll()
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
                 return
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_SPACE:
-                    show_welcome = False
-                elif event.key == pygame.K_ESCAPE:
-                    return
-    
-    # Start the music
-    if music_path:
-        pygame.mixer.music.play()
-    song_started = True
-    start_time = time.time()
-    
-    # Main game loop
-    while running:
-        current_time = time.time() - start_time
-        
-        # Reset active key after a short time
-        if active_key and time.time() - key_press_time > 0.1:
-            active_key = None
+            time.sleep(min(INPUT_POLL_INTERVAL, remaining))
+
+# Start the analysis worker and import librosa in it while the menu is shown
+def start_background_warm_up():
+    get_analysis_worker().warm_up()
+
+# Base class for the screens of the game. The SceneManager calls enter
+# when a scene becomes active and exit when it is left; exit is where a
+# scene lets go of everything it loaded for itself.
+class Scene:
+    manager = None
+    
+    def enter(self):
+        pass
+    
+    def exit(self):
+        pass
+    
+    def handle_event(self, event):
+        pass
+    
+    # Lane key press read by the InputPoller at the given perf_counter time
+    def on_lane_key(self, lane, counter):
+        pass
+    
+    def on_lane_release(self, lane, counter):
+        pass
+    
+    def update(self):
+        pass
+    
+    def draw(self, surface):
+        pass
+    
+    # Something was drawn over the frame in rect after draw
+    def mark_dirty(self, rect):
+        pass
+    
+    # Draw the next frame in full, as the screen was changed from outside
+    def redraw(self):
+        pass
+    
+    def present(self):
+        present_screen()
+
+# Runs one scene at a time with a single clock and event pump. Scenes
+# switch with switch()/back_to_menu(); the change happens between frames
+# so each scene's exit runs before the next one enters.
+class SceneManager:
+    def __init__(self, scene, menu_scene=None):
+        self.scene = scene
+        self.menu_scene = menu_scene    # Makes the scene for back_to_menu (None ends the run)
+        self.next_scene = None
+        self.switching = False
+        self.running = False
+        self.mouse_pos = (0, 0)
+        self.mouse_click = False
+        self.input_poller = InputPoller(self.on_lane_key, self.on_lane_release)
+        
+    def on_lane_key(self, lane, counter):
+        self.scene.on_lane_key(lane, counter)
+    
+    def on_lane_release(self, lane, counter):
+        self.scene.on_lane_release(lane, counter)
+    
+    def switch(self, scene):
+        self.next_scene = scene
+        self.switching = True
+    
+    def back_to_menu(self):
+        self.switch(self.menu_scene() if self.menu_scene else None)
+    
+    def quit(self):
+        self.switch(None)
+    
+    def apply_switch(self):
+        self.scene.exit()
+        self.scene = self.next_scene
+        self.next_scene = None
+        self.switching = False
+        if self.scene is None:
+            self.running = False
+        else:
+            self.scene.manager = self
+            self.scene.enter()
+    
+    def run(self):
+        self.running = True
+        self.scene.manager = self
+        self.scene.enter()
+        next_frame = time.perf_counter()
+        
+        # With vsync, present blocks until the display refresh and paces the frames.
+        # No input is read while it blocks, so poll right before it.
+        vsync_paced = texture_display is not None and texture_display.vsync
+        
+        while self.running:
+            profiler.begin_frame()
+            self.mouse_pos = pygame.mouse.get_pos()
+            self.mouse_click = False
+            for event in self.input_poller.events():
+                if event.type == pygame.QUIT:
+                    self.quit()
+                elif event.type == pygame.KEYDOWN and event.key == PROFILER_KEY:
+                    profiler.show = not profiler.show
+                    self.scene.redraw()
+                    continue
+                elif event.type == pygame.MOUSEMOTION:
+                    self.mouse_pos = event.pos
+                elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:  # Left mouse button
+                    self.mouse_pos = event.pos
+                    self.mouse_click = True
+                self.scene.handle_event(event)
             
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
+            profiler.mark('events')
             
-            # Handle key presses
-            if event.type == pygame.KEYDOWN:
-                key_hit = None
-                if event.key == pygame.K_LEFT:
-                    key_hit = 'left'
-                elif event.key == pygame.K_UP:
-                    key_hit = 'up'
-                elif event.key == pygame.K_DOWN:
-                    key_hit = 'down'
-                elif event.key == pygame.K_RIGHT:
-                    key_hit = 'right'
-                elif event.key == pygame.K_ESCAPE:
-                    running = False
-                
-                # Update active key for visual feedback
-                if key_hit:
-                    active_key = key_hit
-                    key_press_time = time.time()
-                
-                # Check if any arrows can be hit - prioritize arrows closest to hit line
-                if key_hit:
-                    hit_candidates = []
-                    for i, arrow in enumerate(arrows):
-                        if not arrow.hit and not arrow.miss and arrow.direction == key_hit and abs(arrow.y - HIT_LINE_Y) <= GOOD_THRESHOLD:
-                            hit_candidates.append((i, abs(arrow.y - HIT_LINE_Y)))
-                    
-                    if hit_candidates:
-                        # Sort by distance to hit line
-                        hit_candidates.sort(key=lambda x: x[1])
-                        idx, distance = hit_candidates[0]
-                        
-                        # Apply hit
-                        arrows[idx].hit = True
-                        arrows[idx].hit_time = time.time()
-                        
-                        if distance <= PERFECT_THRESHOLD:
-                            arrows[idx].hit_type = 'perfect'
-                            score += 100
-                            combo += 1
-                            if perfect_sound:
-                                perfect_sound.play()
-                        else:
-                            arrows[idx].hit_type = 'good'
-                            score += 50
-                            combo += 1
-                            if hit_sound:
-                                hit_sound.play()
-                                
-                        if combo > max_combo:
-                            max_combo = combo
-        
-        # Clear the screen
-        screen.fill(BLACK)
-        
-        # Update and spawn arrows
-        for arrow in arrows:
-            if not arrow.miss and current_time >= arrow.spawn_time:
-                arrow.update(current_time)
-                arrow.draw(screen)
+            if not self.switching:
+                self.scene.update()
+            if self.switching:
+                self.apply_switch()
+                continue
+            profiler.mark('update')
+            
+            self.scene.draw(screen)
+            if profiler.show:
+                self.scene.mark_dirty(profiler.draw(screen))
+            profiler.mark('draw')
+            if vsync_paced:
+                self.input_poller.poll()
+            self.scene.present()
+            profiler.mark('flip')
+            if self.switching:
+                self.apply_switch()
+                continue
             
-            # Check for misses
-            if arrow.y > HIT_LINE_Y + GOOD_THRESHOLD and not arrow.hit and not arrow.miss:
-                arrow.miss = True
-                combo = 0
-        
-        # Draw the targets with active key highlighting
-        draw_targets(active_key)
-        
-        # Draw the score
-        font = pygame.font.SysFont(None, 36)
-        score_text = font.render(f"Score: {score}", True, WHITE)
-        combo_text = font.render(f"Combo: {combo}", True, WHITE)
-        screen.blit(score_text, (20, 20))
-        screen.blit(combo_text, (20, 60))
-        
-        # Display song name
-        song_font = pygame.font.SysFont(None, 24)
-        song_display = song_font.render(f"Song: {song_name}", True, CYAN)
-        screen.blit(song_display, (WIDTH - song_display.get_width() - 20, 20))
+            # Wait for the next frame while still reading input
+            if not vsync_paced:
+                next_frame = max(next_frame + 1 / FPS, time.perf_counter() - 1 / FPS)
+                self.input_poller.wait_until(next_frame)
+            clock.tick()
+            profiler.mark('wait')
+            profiler.end_frame()
+
+# Main menu
+class MenuScene(Scene):
+    def __init__(self, startup=False, exit_after_first_frame=False):
+        self.first_frame = startup      # Only the menu shown at launch reports startup time
+        self.exit_after_first_frame = exit_after_first_frame
         
-        # Check if song is over
-        if current_time > max(beat_times) + 5 and all(arrow.hit or arrow.miss for arrow in arrows):
-            running = False
+    def enter(self):
+        self.play_button = Button(WIDTH//2 - 150, HEIGHT//2 - 70, 300, 60, "Play", GREEN, LIGHT_GREEN)
+        self.calibrate_button = Button(WIDTH//2 - 150, HEIGHT//2 + 10, 300, 60, "Calibrate", BLUE, LIGHT_BLUE)
+        self.quit_button = Button(WIDTH//2 - 150, HEIGHT//2 + 90, 300, 60, "Quit", RED, LIGHT_RED)
         
-        pygame.display.flip()
-        clock.tick(FPS)
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            self.manager.quit()  # Exit game
+    
+    def update(self):
+        mouse_pos, mouse_click = self.manager.mouse_pos, self.manager.mouse_click
+        self.play_button.update(mouse_pos)
+        self.calibrate_button.update(mouse_pos)
+        self.quit_button.update(mouse_pos)
+        
+        # Handle button clicks
+        if self.play_button.is_clicked(mouse_pos, mouse_click):
+            self.manager.switch(SelectionScene())
+        elif self.calibrate_button.is_clicked(mouse_pos, mouse_click):
+            self.manager.switch(CalibrationScene())
+        elif self.quit_button.is_clicked(mouse_pos, mouse_click):
+            self.manager.quit()  # Exit game
+    
+    def draw(self, surface):
+        surface.fill(BLACK)
+        title = render_text("Heat the beat", 64, WHITE)
+        surface.blit(title, (WIDTH//2 - title.get_width()//2, HEIGHT//4))
+        self.play_button.draw(surface)
+        self.calibrate_button.draw(surface)
+        self.quit_button.draw(surface)
     
-    # Game over screen
-    show_game_over = True
-    while show_game_over:
-        screen.fill(BLACK)
-        font = pygame.font.SysFont(None, 48)
-        title = font.render("Game Over", True, WHITE)
-        score_text = font.render(f"Final Score: {score}", True, WHITE)
-        combo_text = font.render(f"Max Combo: {max_combo}", True, WHITE)
+    def present(self):
+        present_screen()
         
-        # Create buttons
-        play_again_button = Button(WIDTH//2 - 150, HEIGHT//2 + 100, 300, 50, "Play Again", GREEN, LIGHT_GREEN)
-        main_menu_button = Button(WIDTH//2 - 150, HEIGHT//2 + 160, 300, 50, "Main Menu", BLUE, LIGHT_BLUE)
+        # Everything else loads once the menu is visible
+        if self.first_frame:
+            self.first_frame = False
+            print(f"First frame after {(time.perf_counter() - STARTUP_COUNTER) * 1000:.0f} ms")
+            if self.exit_after_first_frame:
+                self.manager.quit()
+            else:
+                start_background_warm_up()
+
+# A row of the song list: the name on the left, length and tempo on the right
+class SongRow(Button):
+    def __init__(self, x, y, width, height):
+        super().__init__(x, y, width, height, "", DARK_GRAY, GRAY)
+        self.info = ""
+        self.selected = False
+        
+    def draw(self, surface):
+        color = self.hover_color if self.hovered or self.selected else self.color
+        pygame.draw.rect(surface, color, self.rect)
+        pygame.draw.rect(surface, CYAN if self.selected else WHITE, self.rect, 2)
+        
+        text_surf = render_text(self.text, 28, self.text_color)
+        surface.blit(text_surf, text_surf.get_rect(midleft=(self.rect.x + 12, self.rect.centery)))
+        info_surf = render_text(self.info, 24, LIGHT_BLUE)
+        surface.blit(info_surf, info_surf.get_rect(midright=(self.rect.right - 12, self.rect.centery)))
+
+# Length, tempo and analysis status of a library entry for its row
+def song_info(entry):
+    parts = []
+    if entry['duration']:
+        minutes, seconds = divmod(int(entry['duration']), 60)
+        parts.append(f"{minutes}:{seconds:02d}")
+    if entry['tempo']:
+        parts.append(f"{entry['tempo']:.0f} BPM")
+    if entry['status'] == 'failed':
+        parts.append("failed")
+    elif entry['status'] != 'analyzed':
+        parts.append("new")
+    return "  ".join(parts)
+
+# Song selection screen. Only the rows that fit on screen exist; scrolling
+# changes which library entries they show.
+class SelectionScene(Scene):
+    LIST_TOP = 130
+    LIST_BOTTOM = HEIGHT - 90
+    
+    def enter(self):
+        self.songs = get_song_library().refresh()
+        if not self.songs:
+            print("No music files found in assets folder.")
+            print("Please add .mp3, .wav or .ogg files to assets folder.")
+            
+            # Add a default song option (will use built-in beat pattern)
+            self.songs = [{'path': None, 'duration': None, 'tempo': None, 'status': 'analyzed'}]
         
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, HEIGHT//4))
-        screen.blit(score_text, (WIDTH//2 - score_text.get_width()//2, HEIGHT//2))
-        screen.blit(combo_text, (WIDTH//2 - combo_text.get_width()//2, HEIGHT//2 + 50))
+        # Create one row per visible line of the list
+        row_width = 600
+        visible_rows = (self.LIST_BOTTOM - self.LIST_TOP) // LIBRARY_ROW_HEIGHT
+        self.rows = [
+            SongRow(WIDTH//2 - row_width//2, self.LIST_TOP + LIBRARY_ROW_HEIGHT * i, row_width, LIBRARY_ROW_HEIGHT - 8)
+            for i in range(visible_rows)
+        ]
         
-        mouse_pos = pygame.mouse.get_pos()
-        mouse_click = False
+        # Add back button
+        self.back_button = Button(30, HEIGHT - 70, 120, 40, "Back", RED, LIGHT_RED)
         
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
+        self.query = ""
+        self.matches = self.songs
+        self.scroll = 0
+        self.selected = 0
+        
+        # Songs hovered long enough are analyzed in the background before they are clicked
+        self.worker = get_analysis_worker()
+        self.hovered_song = None
+        self.hover_start = 0
+        self.chosen_song = None
+    
+    # Drop the guess if another song (or none) was picked, so it doesn't hold up the worker
+    def exit(self):
+        job = self.worker.speculative_job
+        if job and job.music_path != self.chosen_song:
+            self.worker.cancel(job)
+    
+    def set_query(self, query):
+        self.query = query
+        needle = query.lower()
+        self.matches = [song for song in self.songs if needle in song_name(song['path']).lower()]
+        self.scroll = 0
+        self.selected = 0
+    
+    # Move the keyboard selection, scrolling to keep it on screen
+    def select(self, index):
+        if not self.matches:
+            return
+        self.selected = min(max(index, 0), len(self.matches) - 1)
+        if self.selected < self.scroll:
+            self.scroll = self.selected
+        elif self.selected >= self.scroll + len(self.rows):
+            self.scroll = self.selected - len(self.rows) + 1
+    
+    def scroll_by(self, rows):
+        max_scroll = max(0, len(self.matches) - len(self.rows))
+        self.scroll = min(max(self.scroll + rows, 0), max_scroll)
+    
+    def play(self, song):
+        if song['path'] is None:
+            print("Using a built-in beat pattern for now")
+        self.chosen_song = song['path']
+        self.manager.switch(ReadyScene(song['path']))
+    
+    def handle_event(self, event):
+        if event.type == pygame.MOUSEWHEEL:
+            self.scroll_by(-event.y)
+        elif event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                # Clear the search first, then go back
+                if self.query:
+                    self.set_query("")
+                else:
+                    self.manager.back_to_menu()
+            elif event.key in (pygame.K_RETURN, pygame.K_KP_ENTER):
+                if self.matches:
+                    self.play(self.matches[self.selected])
+            elif event.key == pygame.K_PAGEUP:
+                self.select(self.selected - len(self.rows))
+            elif event.key == pygame.K_PAGEDOWN:
+                self.select(self.selected + len(self.rows))
+            elif event.key == pygame.K_BACKSPACE:
+                self.set_query(self.query[:-1])
+            elif event.unicode and event.unicode.isprintable():
+                self.set_query(self.query + event.unicode)
+    
+    # The arrow keys are lane keys, so up and down arrive here
+    def on_lane_key(self, lane, counter):
+        if DIRECTIONS[lane] == 'up':
+            self.select(self.selected - 1)
+        elif DIRECTIONS[lane] == 'down':
+            self.select(self.selected + 1)
+    
+    def update(self):
+        mouse_pos, mouse_click = self.manager.mouse_pos, self.manager.mouse_click
+        self.worker.poll()
+        
+        # Point the rows at the entries currently scrolled into view
+        hovered_now = None
+        for i, row in enumerate(self.rows):
+            index = self.scroll + i
+            if index >= len(self.matches):
+                row.hovered = False
+                continue
+            song = self.matches[index]
+            row.text = song_name(song['path'], 32)
+            row.info = song_info(song)
+            row.selected = index == self.selected
+            row.update(mouse_pos)
+            if row.hovered and song['path']:
+                hovered_now = song['path']
+            
+            # Check for click
+            if row.is_clicked(mouse_pos, mouse_click):
+                self.play(song)
                 return
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                if event.button == 1:  # Left mouse button
-                    mouse_click = True
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    show_game_over = False  # Return to main menu
         
-        # Update and draw buttons
-        play_again_button.update(mouse_pos)
-        play_again_button.draw(screen)
+        # Start analyzing a song once the pointer rests on it
+        if hovered_now != self.hovered_song:
+            self.hovered_song = hovered_now
+            self.hover_start = time.time()
+        elif self.hovered_song and time.time() - self.hover_start >= SPECULATIVE_HOVER_DELAY:
+            self.worker.speculate(self.hovered_song)
+        
+        self.back_button.update(mouse_pos)
+        if self.back_button.is_clicked(mouse_pos, mouse_click):
+            self.manager.back_to_menu()
+    
+    def draw(self, surface):
+        surface.fill(BLACK)
+        
+        # Draw title and search box
+        title = render_text("Select a Song", 48, WHITE)
+        surface.blit(title, (WIDTH//2 - title.get_width()//2, 30))
+        search = render_text(f"Search: {self.query}_" if self.query else "Type to search", 28, YELLOW if self.query else GRAY)
+        surface.blit(search, (WIDTH//2 - 300, 90))
+        count = render_text(f"{len(self.matches)} songs", 24, GRAY)
+        surface.blit(count, (WIDTH//2 + 300 - count.get_width(), 92))
+        
+        # Draw only the rows that show a song
+        for row in self.rows[:len(self.matches) - self.scroll]:
+            row.draw(surface)
+        self.back_button.draw(surface)
+        
+        # Draw scroll bar
+        if len(self.matches) > len(self.rows):
+            track = pygame.Rect(WIDTH//2 + 310, self.LIST_TOP, 6, len(self.rows) * LIBRARY_ROW_HEIGHT - 8)
+            thumb_height = max(20, track.height * len(self.rows) // len(self.matches))
+            thumb_y = track.y + (track.height - thumb_height) * self.scroll // (len(self.matches) - len(self.rows))
+            pygame.draw.rect(surface, DARK_GRAY, track)
+            pygame.draw.rect(surface, WHITE, (track.x, thumb_y, track.width, thumb_height))
+        
+        # Draw instructions
+        instructions = render_text("Click a song or press Enter to play", 24, WHITE)
+        surface.blit(instructions, (WIDTH//2 - instructions.get_width()//2, HEIGHT - 50))
+
+# "Get Ready" screen, shown while the song is analyzed in the background
+class ReadyScene(Scene):
+    def __init__(self, music_path, beatmap=None, difficulty=None):
+        self.music_path = music_path
+        self.beatmap = beatmap      # Known when playing again, so there is nothing to analyze
+        self.difficulty = difficulty or DIFFICULTY
+        self.song_name = os.path.basename(music_path) if music_path else "Default Beat Pattern"
+        
+    def enter(self):
+        # Analyze music to get beat times in the background while this screen runs
+        analyze = self.music_path and self.beatmap is None
+        self.worker = get_analysis_worker() if analyze else None
+        self.analysis_job = self.worker.submit(self.music_path) if analyze else None
+        self.starting = False
+        self.recorded = False
+    
+    def exit(self):
+        # The job can finish after the last update, when SPACE starts the song right away
+        self.record_outcome()
+        
+        # Leaving without playing: stop the analysis
+        if not self.starting and self.analysis_job:
+            self.worker.cancel(self.analysis_job)
+        self.analysis_job = None
+    
+    def analysis_ready(self):
+        return self.analysis_job is None or self.analysis_job.done()
+    
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_SPACE and self.analysis_ready():
+                beatmap = self.beatmap or (self.analysis_job.result() if self.analysis_job else default_beatmap())
+                self.starting = True
+                
+                # Load the music once analyzed, when its decoded copy is in the cache
+                if self.music_path:
+                    pygame.mixer.music.load(playback_path(self.music_path))
+                self.manager.switch(PlayScene(self.music_path, beatmap, self.difficulty, replay_path=new_replay_path(self.music_path)))
+            elif event.key == pygame.K_ESCAPE:
+                self.manager.back_to_menu()
+    
+    # Left and right arrows pick the difficulty
+    def on_lane_key(self, lane, counter):
+        tiers = list(DIFFICULTIES)
+        step = {'left': -1, 'right': 1}.get(DIRECTIONS[lane], 0)
+        self.difficulty = tiers[(tiers.index(self.difficulty) + step) % len(tiers)]
+    
+    # Remember the outcome in the song library once the analysis is done
+    def record_outcome(self):
+        if self.recorded or not self.analysis_job or not self.analysis_job.done() or self.analysis_job.cancelled:
+            return
+        self.recorded = True
+        beatmap, status = self.analysis_job.outcome()
+        get_song_library().record_analysis(self.music_path, status, beatmap.times if status == 'analyzed' else None)
+    
+    def update(self):
+        if self.worker:
+            self.worker.poll()
+            self.record_outcome()
+    
+    def draw(self, surface):
+        analysis_ready = self.analysis_ready()
+        
+        surface.fill(BLACK)
+        title = render_text("Get Ready!", 48, WHITE)
+        song_text = render_text(f"Song: {self.song_name}", 36, CYAN)
+        difficulty_text = render_text(f"< Difficulty: {self.difficulty.capitalize()} >", 28, WHITE)
+        inst_text1 = render_text("Press the arrow keys to hit the notes when they reach the white line", 28, WHITE)
+        if analysis_ready:
+            inst_text2 = render_text("Press SPACE to start", 28, GREEN)
+        else:
+            job = self.analysis_job
+            inst_text2 = render_text(f"Analyzing song... {job.stage} ({int(job.progress * 100)}%)", 28, YELLOW)
+        
+        surface.blit(title, (WIDTH//2 - title.get_width()//2, HEIGHT//4))
+        surface.blit(song_text, (WIDTH//2 - song_text.get_width()//2, HEIGHT//4 + 60))
+        surface.blit(difficulty_text, (WIDTH//2 - difficulty_text.get_width()//2, HEIGHT//4 + 105))
+        surface.blit(inst_text1, (WIDTH//2 - inst_text1.get_width()//2, HEIGHT//2))
+        surface.blit(inst_text2, (WIDTH//2 - inst_text2.get_width()//2, HEIGHT//2 + 50))
+        
+        # Draw analysis progress bar
+        if not analysis_ready:
+            bar_rect = pygame.Rect(WIDTH//2 - 200, HEIGHT//2 + 90, 400, 16)
+            pygame.draw.rect(surface, DARK_GRAY, bar_rect)
+            pygame.draw.rect(surface, YELLOW, (bar_rect.x, bar_rect.y, int(bar_rect.width * self.analysis_job.progress), bar_rect.height))
+            pygame.draw.rect(surface, WHITE, bar_rect, 1)
+
+# Play the actual rhythm game with the selected song
+class PlayScene(Scene):
+    def __init__(self, music_path, beatmap, difficulty=None, seed=None, song_clock=None, replay_path=None):
+        self.music_path = music_path
+        self.beatmap = beatmap
+        self.difficulty = difficulty or DIFFICULTY
+        self.seed = seed
+        self.song_clock = song_clock
+        self.replay_path = replay_path  # Where the replay is saved when the run ends (None: not saved)
+        self.song_name = os.path.basename(music_path) if music_path else "Default Beat Pattern"
+        
+    def enter(self):
+        # Generate arrows based on beat times, with a seed the replay can rebuild them from
+        if self.seed is None:
+            self.seed = random.randrange(2 ** 32)
+        self.chart = self.beatmap.chart(self.difficulty, self.seed)
         
-        main_menu_button.update(mouse_pos)
-        main_menu_button.draw(screen)
+        # Game variables
+        self.timing = TimingStats()
+        self.judge = Judge(self.chart, timing=self.timing)
+        self.replay = ReplayRecorder()
+        self.active_key = None
+        self.key_press_time = 0.0   # Song time of the last press, which lights its target for a moment
+        self.current_time = 0.0
+        
+        # Delay the music if the first arrows need time to fall from the top of the screen
+        lead_in = max(0.0, ARROW_LEAD_TIME - self.chart.times[0]) if len(self.chart) else 0.0
+        if self.song_clock is None:
+            self.song_clock = SongClock(has_music=bool(self.music_path))
+        self.song_clock.start(lead_in)
+        
+        self.renderer = GameplayRenderer(self.song_name)
+    
+    def exit(self):
+        # Free everything that belongs to this session
+        if self.music_path:
+            pygame.mixer.music.stop()
+            pygame.mixer.music.unload()
+        self.chart = None
+        self.beatmap = None
+        self.renderer = None
+        self.song_clock = None
+        self.judge = None
+        self.replay = None
+    
+    # Judge a lane key press at the song time it was read
+    def on_lane_key(self, lane, counter):
+        # Judge the press at its time as recorded, so replays are judged the same
+        press_time = self.replay.record(lane, self.song_clock.time_at(counter), True, self.judge.song_time)
+        
+        # Update active key for visual feedback
+        self.active_key = DIRECTIONS[lane]
+        self.key_press_time = press_time
+        judgement = self.judge.press(lane, press_time)
+        if judgement == JUDGE_PERFECT:
+            get_audio().play_hit('perfect')
+        elif judgement == JUDGE_GOOD:
+            get_audio().play_hit('good')
+    
+    def on_lane_release(self, lane, counter):
+        self.replay.record(lane, self.song_clock.time_at(counter), False, self.judge.song_time)
+    
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.finish()
+            elif event.key == pygame.K_F2:
+                self.renderer.toggle_dirty_rects()
+    
+    def finish(self):
+        if self.replay_path:
+            self.save_replay(self.replay_path)
+        timing_path = os.path.splitext(self.replay_path or new_replay_path(self.music_path))[0] + '.timing.json'
+        self.manager.switch(ResultsScene(self.music_path, self.beatmap, self.difficulty, self.judge.score, self.judge.max_combo,
+                                         self.timing, timing_path))
+    
+    # Save the inputs of this run with what is needed to judge them again
+    def save_replay(self, path):
+        judge = self.judge
+        meta = {
+            'song': self.music_path,
+            'content_hash': music_content_hash(self.music_path) if self.music_path else None,
+            'analysis': analysis_params() if self.music_path else None,
+            'difficulty': self.difficulty,
+            'seed': self.seed,
+            'chart_hash': self.chart.content_hash(),
+            'thresholds_ms': [PERFECT_THRESHOLD, GOOD_THRESHOLD],
+            'audio_offset_ms': AUDIO_OFFSET_MS,
+            'end_time': self.current_time,
+            'score': judge.score,
+            'max_combo': judge.max_combo,
+            'judgements': self.chart.judgement_counts(),
+            'recorded': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        try:
+            save_replay(path, meta, self.replay)
+            print(f"Replay saved to {path}")
+        except OSError as e:
+            print(f"Could not save replay: {e}")
+    
+    def update(self):
+        self.song_clock.update()
+        self.current_time = self.song_clock.time()
+        
+        # Reset active key after a short time (in song time, so simulations draw the same frames)
+        if self.active_key and self.current_time - self.key_press_time > 0.1:
+            self.active_key = None
+        
+        # Update and spawn arrows, breaking the combo on misses
+        self.judge.advance(self.current_time)
+        profiler.count('notes', self.chart.next_spawn - self.chart.first_visible)
+        
+        # Check if song is over
+        if self.chart.is_finished(self.current_time):
+            self.finish()
+    
+    def draw(self, surface):
+        # Draw arrows, targets with active key highlighting, score and song name
+        self.renderer.draw(self.chart, self.current_time, self.active_key, self.judge.score, self.judge.combo)
+    
+    def mark_dirty(self, rect):
+        self.renderer.mark_dirty(rect)
+    
+    def redraw(self):
+        self.renderer.reset()
+    
+    def present(self):
+        self.renderer.present()
+
+# Game over screen
+class ResultsScene(Scene):
+    def __init__(self, music_path, beatmap, difficulty, score, max_combo, timing=None, timing_path=None):
+        self.music_path = music_path
+        self.beatmap = beatmap
+        self.difficulty = difficulty
+        self.score = score
+        self.max_combo = max_combo
+        self.timing = timing            # TimingStats of the run
+        self.timing_path = timing_path  # Where E exports them
+        self.exported = False
+        
+    def enter(self):
+        self.play_again_button = Button(WIDTH//2 - 150, HEIGHT//2 + 100, 300, 50, "Play Again", GREEN, LIGHT_GREEN)
+        self.main_menu_button = Button(WIDTH//2 - 150, HEIGHT//2 + 160, 300, 50, "Main Menu", BLUE, LIGHT_BLUE)
+    
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            self.manager.back_to_menu()  # Return to main menu
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_e and self.timing and self.timing_path:
+            try:
+                self.timing.export(self.timing_path, song=self.music_path, difficulty=self.difficulty,
+                                   audio_offset_ms=AUDIO_OFFSET_MS)
+                self.exported = True
+                print(f"Timing exported to {self.timing_path}")
+            except OSError as e:
+                print(f"Could not export timing: {e}")
+    
+    def update(self):
+        mouse_pos, mouse_click = self.manager.mouse_pos, self.manager.mouse_click
+        self.play_again_button.update(mouse_pos)
+        self.main_menu_button.update(mouse_pos)
         
         # Handle button clicks
-        if play_again_button.is_clicked(mouse_pos, mouse_click):
-            show_game_over = False
-            play_game(music_path)  # Play the same song again
+        if self.play_again_button.is_clicked(mouse_pos, mouse_click):
+            self.manager.switch(ReadyScene(self.music_path, self.beatmap, self.difficulty))  # Play the same song again
+        elif self.main_menu_button.is_clicked(mouse_pos, mouse_click):
+            self.manager.back_to_menu()
+    
+    def draw(self, surface):
+        surface.fill(BLACK)
+        title = render_text("Game Over", 48, WHITE)
+        score_text = render_text(f"Final Score: {self.score}", 48, WHITE)
+        combo_text = render_text(f"Max Combo: {self.max_combo}", 48, WHITE)
+        
+        surface.blit(title, (WIDTH//2 - title.get_width()//2, HEIGHT//4))
+        surface.blit(score_text, (WIDTH//2 - score_text.get_width()//2, HEIGHT//2))
+        surface.blit(combo_text, (WIDTH//2 - combo_text.get_width()//2, HEIGHT//2 + 50))
+        
+        # How early or late the hits were
+        if self.timing and len(self.timing):
+            stats = self.timing.summary()
+            draw_timing_histogram(surface, pygame.Rect(WIDTH//2 - 165, HEIGHT//4 + 55, 330, 55), self.timing)
+            timing_text = render_text(f"Timing: mean {stats['mean_ms']:+.1f} ms, std {stats['std_ms']:.1f} ms "
+                                      f"({stats['early']} early, {stats['late']} late)", 24, WHITE)
+            surface.blit(timing_text, (WIDTH//2 - timing_text.get_width()//2, HEIGHT//4 + 115))
+            export_text = render_text("Timing exported" if self.exported else "Press E to export the timing", 24, GRAY)
+            surface.blit(export_text, (WIDTH//2 - export_text.get_width()//2, HEIGHT//2 + 220))
+        
+        self.play_again_button.draw(surface)
+        self.main_menu_button.draw(surface)
+
+# The audio offset found by the last calibration, or the default if there was none
+def load_calibration(default=AUDIO_OFFSET_MS):
+    try:
+        with open(CALIBRATION_PATH, encoding='utf-8') as f:
+            return int(json.load(f)['audio_offset_ms'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return default
+
+def save_calibration(offset_ms, std_ms, presses):
+    os.makedirs(os.path.dirname(CALIBRATION_PATH), exist_ok=True)
+    with open(CALIBRATION_PATH, 'w', encoding='utf-8') as f:
+        json.dump({'audio_offset_ms': offset_ms, 'std_ms': std_ms, 'presses': presses,
+                   'calibrated': time.strftime('%Y-%m-%dT%H:%M:%S')}, f, indent=2)
+
+# Plays a click track with a flash on every click and measures how late
+# the player presses on them, which is the audio output, input and
+# display latency together. The median becomes AUDIO_OFFSET_MS, which
+# moves both the judgement and the arrows.
+class CalibrationScene(Scene):
+    def enter(self):
+        duration = (CALIBRATION_CLICKS + 1) * CALIBRATION_INTERVAL
+        self.click_times = np.arange(1, CALIBRATION_CLICKS + 1) * CALIBRATION_INTERVAL
+        self.track_path = os.path.join('cache', 'calibration-click.wav')
+        os.makedirs('cache', exist_ok=True)
+        soundfile.write(self.track_path, synthetic_audio('click', duration, MIXER_SAMPLE_RATE), MIXER_SAMPLE_RATE, subtype='PCM_16')
+        pygame.mixer.music.load(self.track_path)
+        
+        # The song clock already covers the mixer buffer; the offset is measured on top of it
+        self.song_clock = SongClock(has_music=True, offset_ms=0)
+        self.song_clock.start(1.0)
+        self.current_time = -1.0
+        self.errors = []
+        self.done = False
+        self.result = None      # (offset ms, std ms) if there were enough presses
+    
+    def exit(self):
+        pygame.mixer.music.stop()
+        pygame.mixer.music.unload()
+    
+    def on_lane_key(self, lane, counter):
+        if self.done:
+            return
+        press_time = self.song_clock.time_at(counter)
+        nearest = int(np.abs(self.click_times - press_time).argmin())
+        error = press_time - self.click_times[nearest]
+        if nearest >= CALIBRATION_WARMUP_CLICKS and abs(error) < CALIBRATION_INTERVAL / 2:
+            self.errors.append(error)
+    
+    def handle_event(self, event):
+        global AUDIO_OFFSET_MS
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_ESCAPE:
+                self.manager.back_to_menu()
+            elif event.key == pygame.K_RETURN and self.result:
+                offset_ms, std_ms = self.result
+                AUDIO_OFFSET_MS = offset_ms
+                try:
+                    save_calibration(offset_ms, std_ms, len(self.errors))
+                except OSError as e:
+                    print(f"Could not save calibration: {e}")
+                print(f"Audio offset set to {offset_ms} ms")
+                self.manager.back_to_menu()
+    
+    def update(self):
+        if self.done:
+            return
+        self.song_clock.update()
+        self.current_time = self.song_clock.time()
+        if self.current_time > self.click_times[-1] + 1.0:
+            self.done = True
+            pygame.mixer.music.stop()
+            if len(self.errors) >= CALIBRATION_MIN_PRESSES:
+                errors = np.array(self.errors) * 1000
+                self.result = (int(round(np.median(errors))), float(errors.std()))
+    
+    def draw(self, surface):
+        surface.fill(BLACK)
+        title = render_text("Calibration", 48, WHITE)
+        surface.blit(title, (WIDTH//2 - title.get_width()//2, HEIGHT//4))
+        
+        if not self.done:
+            lines = [("Press an arrow key on every click", WHITE),
+                     (f"Click {int(np.searchsorted(self.click_times, self.current_time, side='right'))}/{CALIBRATION_CLICKS}", GRAY)]
             
-        if main_menu_button.is_clicked(mouse_pos, mouse_click):
-            show_game_over = False  # Return to main menu
+            # Flash with each click, as the arrows would reach the line
+            since_click = self.current_time - self.click_times
+            flash = np.any((since_click >= 0) & (since_click < 0.1))
+            center = (WIDTH//2, HEIGHT//2 + 40)
+            pygame.draw.circle(surface, CYAN if flash else DARK_GRAY, center, 40)
+            pygame.draw.circle(surface, WHITE, center, 40, 2)
+        elif self.result:
+            offset_ms, std_ms = self.result
+            lines = [(f"Offset {offset_ms:+d} ms (spread {std_ms:.0f} ms over {len(self.errors)} presses)", CYAN),
+                     ("Press ENTER to use it or ESC to cancel", WHITE)]
+        else:
+            lines = [("Not enough presses on the clicks", YELLOW), ("Press ESC to go back", WHITE)]
         
-        pygame.display.flip()
-        clock.tick(FPS)
+        for i, (text, color) in enumerate(lines):
+            line = render_text(text, 28, color)
+            surface.blit(line, (WIDTH//2 - line.get_width()//2, HEIGHT//4 + 70 + 35 * i))
+
+# Measure the latency offset outside the menus
+def calibrate():
+    init_display()
+    try:
+        SceneManager(CalibrationScene()).run()
+    finally:
+        pygame.quit()
+
+# Main game function
+def main(exit_after_first_frame=False):
+    init_display()
+    print(f"Audio: {get_audio().describe()}")
+    try:
+        SceneManager(MenuScene(True, exit_after_first_frame), menu_scene=MenuScene).run()
+    finally:
+        shutdown_analysis_worker()
+        pygame.quit()
+
+# Play one song from the "Get Ready" screen until the player leaves the results
+def play_game(music_path):
+    SceneManager(ReadyScene(music_path)).run()
+
+# Presses each note's lane at its beat time, optionally off by a random
+# timing error, so a song can be played without a human
+class AutoPlayer:
+    def __init__(self, chart, seed=0, error_ms=0.0):
+        press_times = chart.times.copy()
+        if error_ms:
+            press_times += np.random.default_rng(seed).normal(0.0, error_ms / 1000, len(press_times))
+        order = np.argsort(press_times, kind='stable')
+        self.times = press_times[order]
+        self.lanes = chart.lanes[order]
+        self.next = 0
+    
+    # (lane, song time) of the presses due up to the given song time
+    def presses(self, until):
+        end = int(np.searchsorted(self.times, until, side='right'))
+        for i in range(self.next, end):
+            yield int(self.lanes[i]), float(self.times[i])
+        self.next = end
+
+# Plays a PlayScene on a VirtualClock with an AutoPlayer, one fixed step
+# per frame and as fast as the frames can be drawn. Stops when the song
+# ends and returns a report instead of showing the results screen.
+class SimulationManager(SceneManager):
+    PHASES = ('events', 'update', 'draw', 'present')
+    
+    def __init__(self, scene, seed=0, error_ms=0.0):
+        super().__init__(scene)
+        self.seed = seed
+        self.error_ms = error_ms
+    
+    def run(self):
+        scene = self.scene
+        scene.manager = self
+        scene.enter()
+        song_clock = scene.song_clock
+        autoplayer = AutoPlayer(scene.chart, self.seed, self.error_ms)
+        timings = []
+        start = time.perf_counter()
+        
+        self.running = True
+        while not self.switching:
+            t0 = time.perf_counter()
+            pygame.event.pump()
+            song_clock.advance()
+            for lane, press_time in autoplayer.presses(song_clock.time()):
+                scene.on_lane_key(lane, press_time)
+            t1 = time.perf_counter()
+            scene.update()
+            t2 = time.perf_counter()
+            if self.switching:
+                break
+            scene.draw(screen)
+            t3 = time.perf_counter()
+            scene.present()
+            t4 = time.perf_counter()
+            timings.append((t1 - t0, t2 - t1, t3 - t2, t4 - t3))
+        elapsed = time.perf_counter() - start
+        
+        phase_times = np.array(timings).reshape(-1, len(self.PHASES)) * 1000
+        frame_times = phase_times.sum(axis=1)
+        report = {
+            'song': scene.song_name,
+            'difficulty': scene.difficulty,
+            'seed': self.seed,
+            'autoplay_error_ms': self.error_ms,
+            'notes': len(scene.chart),
+            'score': scene.judge.score,
+            'max_combo': scene.judge.max_combo,
+            'judgements': scene.chart.judgement_counts(),
+            'timing': scene.timing.summary(),
+            'frames': len(frame_times),
+            'song_seconds': song_clock.time(),
+            'wall_seconds': elapsed,
+            'frame_ms': {
+                'mean': float(frame_times.mean()),
+                'p50': float(np.percentile(frame_times, 50)),
+                'p95': float(np.percentile(frame_times, 95)),
+                'p99': float(np.percentile(frame_times, 99)),
+                'max': float(frame_times.max()),
+            },
+            'phase_mean_ms': {phase: float(phase_times[:, i].mean()) for i, phase in enumerate(self.PHASES)},
+            'frame_times_ms': [round(float(t), 4) for t in frame_times],
+        }
+        
+        # End the run without entering the results screen
+        self.next_scene = None
+        self.apply_switch()
+        return report
+
+# Play a whole song headless with autoplay, faster than real time, and
+# report the score and frame timings. The same song, seed and settings
+# always give the same score.
+def simulate(music_path=None, seed=0, error_ms=0.0, report_path=None, replay_path=None):
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    init_display()
+    try:
+        beatmap = analyze_music(music_path) if music_path else default_beatmap()
+        scene = PlayScene(music_path, beatmap, seed=seed, song_clock=VirtualClock(), replay_path=replay_path)
+        report = SimulationManager(scene, seed, error_ms).run()
+    finally:
+        pygame.quit()
+    
+    judgements = report['judgements']
+    frame_ms = report['frame_ms']
+    print(f"Simulated {report['song']}: {report['notes']} notes, {report['song_seconds']:.1f}s of song "
+          f"in {report['wall_seconds']:.2f}s ({report['song_seconds'] / report['wall_seconds']:.1f}x real time)")
+    print(f"Score {report['score']}, max combo {report['max_combo']}: "
+          f"{judgements['perfect']} perfect, {judgements['good']} good, {judgements['miss']} missed")
+    print(f"Frame time over {report['frames']} frames: mean {frame_ms['mean']:.2f} ms, p50 {frame_ms['p50']:.2f} ms, "
+          f"p95 {frame_ms['p95']:.2f} ms, p99 {frame_ms['p99']:.2f} ms, max {frame_ms['max']:.2f} ms")
+    print("Mean per phase: " + ", ".join(f"{phase} {ms:.3f} ms" for phase, ms in report['phase_mean_ms'].items()))
+    
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {report_path}")
+    return report
+
+# Lane key presses and releases of a run in song time, as whole ticks
+# (REPLAY_TICKS_PER_SECOND) so a replay is judged on exactly the times
+# the game judged
+class ReplayRecorder:
+    def __init__(self):
+        self.ticks = []
+        self.events = []    # lane << 1 | pressed
+    
+    def __len__(self):
+        return len(self.ticks)
+    
+    # Record an event; returns its song time as stored. The song clock
+    # corrects itself and can stamp an event before the last frame, so
+    # times are moved up to not_before (the time the chart was last moved
+    # to): the judgement then never sees a press before a miss it already
+    # counted, and judging the replay in order gives the same result.
+    def record(self, lane, song_time, pressed, not_before=float('-inf')):
+        ticks = round(max(song_time, not_before) * REPLAY_TICKS_PER_SECOND)
+        while ticks / REPLAY_TICKS_PER_SECOND < not_before:
+            ticks += 1
+        self.ticks.append(ticks)
+        self.events.append(lane << 1 | pressed)
+        return ticks / REPLAY_TICKS_PER_SECOND
+
+# Events are stored as the change in ticks since the previous event
+# (zigzag-encoded, so the format doesn't depend on the times being in
+# order) in a little-endian base-128 varint, then one byte of lane and
+# press/release. A press a few hundred milliseconds after the last takes 4 bytes.
+def encode_replay_events(ticks, events):
+    data = bytearray()
+    previous = 0
+    for tick, event in zip(ticks, events):
+        delta = tick - previous
+        previous = tick
+        value = delta * 2 if delta >= 0 else -delta * 2 - 1
+        while value >= 0x80:
+            data.append(value & 0x7f | 0x80)
+            value >>= 7
+        data.append(value)
+        data.append(event)
+    return bytes(data)
+
+def decode_replay_events(data, count, offset=0):
+    ticks = []
+    events = []
+    tick = 0
+    pos = offset
+    for _ in range(count):
+        value = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        tick += value >> 1 if value % 2 == 0 else -(value + 1 >> 1)
+        ticks.append(tick)
+        events.append(data[pos])
+        pos += 1
+    return ticks, events
+
+# A new replay file named after the time (to the millisecond) and song,
+# with a number added if that name is taken
+def new_replay_path(music_path):
+    name = os.path.splitext(os.path.basename(music_path))[0] if music_path else 'default'
+    now = time.time()
+    stem = os.path.join(REPLAY_DIR, f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now * 1000) % 1000:03d}-{name}")
+    path = f"{stem}.htr"
+    number = 2
+    while os.path.exists(path):
+        path = f"{stem}-{number}.htr"
+        number += 1
+    return path
+
+def save_replay(path, meta, recorder):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    meta = json.dumps(meta, sort_keys=True).encode('utf-8')
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, len(meta), len(recorder)))
+        f.write(meta)
+        f.write(encode_replay_events(recorder.ticks, recorder.events))
+    os.replace(tmp_path, path)
+
+# Read a replay as (metadata, ticks, events); raises ValueError if it isn't one
+def load_replay(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        magic, version, meta_len, count = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError(f"{path} is not a replay this version can read")
+        meta_start = REPLAY_HEADER.size
+        meta = json.loads(data[meta_start:meta_start + meta_len].decode('utf-8'))
+        ticks, events = decode_replay_events(data, count, meta_start + meta_len)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"{path} is damaged: {e}")
+    return meta, ticks, events
+
+# The beatmap a replay was played on: the cached analysis with the
+# recorded parameters, the song analyzed again if it is at hand, or the
+# default beats (which are also used when an analysis fails)
+def replay_beatmaps(meta):
+    if meta['content_hash']:
+        beatmap = load_beatmap(meta['content_hash'], meta['analysis'])
+        if beatmap is not None:
+            yield beatmap
+        song = meta['song']
+        if beatmap is None and song and os.path.exists(song) and music_content_hash(song) == meta['content_hash']:
+            yield detect_onsets(song, profile=meta['analysis']['profile'])
+    yield default_beatmap()
+
+# Judge a replay's presses again, without drawing or waiting, and check
+# the outcome matches the recorded score. Returns a report.
+def verify_replay(path):
+    start = time.perf_counter()
+    meta, ticks, events = load_replay(path)
+    for beatmap in replay_beatmaps(meta):
+        chart = beatmap.chart(meta['difficulty'], meta['seed'])
+        if chart.content_hash() == meta['chart_hash']:
+            break
+    else:
+        return {'replay': path, 'verified': False, 'error': "the chart can't be rebuilt (song or analysis missing or changed)"}
+    
+    judge = Judge(chart, *meta['thresholds_ms'])
+    for tick, event in zip(ticks, events):
+        if event & 1:
+            judge.press(event >> 1, tick / REPLAY_TICKS_PER_SECOND)
+    judge.advance(meta['end_time'])
+    elapsed = time.perf_counter() - start
+    
+    outcome = {'score': judge.score, 'max_combo': judge.max_combo, 'judgements': chart.judgement_counts()}
+    mismatches = [key for key, value in outcome.items() if meta[key] != value]
+    return {
+        'replay': path,
+        'verified': not mismatches,
+        'mismatches': {key: {'recorded': meta[key], 'replayed': outcome[key]} for key in mismatches},
+        'score': judge.score,
+        'events': len(ticks),
+        'seconds': elapsed,
+        'song_seconds': meta['end_time'],
+    }
+
+# Verify replays in bulk; returns the exit status (1 if any fails)
+def verify_replays(paths):
+    failed = 0
+    for path in paths:
+        try:
+            result = verify_replay(path)
+        except (OSError, ValueError, KeyError) as e:
+            result = {'replay': path, 'verified': False, 'error': str(e)}
+        if result['verified']:
+            speed = f" ({result['song_seconds'] / result['seconds']:.0f}x real time)" if result['song_seconds'] > 0 else ""
+            print(f"OK    {path}: score {result['score']}, {result['events']} events in "
+                  f"{result['seconds'] * 1000:.1f} ms{speed}")
+        else:
+            failed += 1
+            problems = result.get('error') or ", ".join(
+                f"{key} recorded {values['recorded']}, replayed {values['replayed']}" for key, values in result['mismatches'].items())
+            print(f"FAIL  {path}: {problems}")
+    print(f"{len(paths) - failed} of {len(paths)} replays verified")
+    return 1 if failed else 0
+
+# Record and verify replays of a synthetic song, first on a fresh analysis
+# (empty caches) and then on the cached beatmap: both must verify, as live
+# judging and replay judging have to see the same note times. Returns the
+# exit status (1 if any fails).
+def check_replays(seed=0, error_ms=80.0):
+    global BEATMAP_CACHE_DIR, PCM_CACHE_DIR
+    cache_dirs = BEATMAP_CACHE_DIR, PCM_CACHE_DIR
+    with tempfile.TemporaryDirectory() as folder:
+        BEATMAP_CACHE_DIR = os.path.join(folder, 'beatmaps')
+        PCM_CACHE_DIR = os.path.join(folder, 'pcm')
+        try:
+            song = os.path.join(folder, 'song.wav')
+            soundfile.write(song, synthetic_audio('noise', 20, 44100, seed), 44100, subtype='PCM_16')
+            paths = []
+            for run in ('analyzed', 'cached'):
+                paths.append(os.path.join(folder, f"{run}.htr"))
+                simulate(song, seed, error_ms, replay_path=paths[-1])
+            return verify_replays(paths)
+        finally:
+            BEATMAP_CACHE_DIR, PCM_CACHE_DIR = cache_dirs
+
+# Synthetic test audio, so the benchmarks run offline: a 120 BPM click
+# track or noise bursts at random times, over a quiet noise floor
+def synthetic_audio(kind, duration, sr, seed=0):
+    rng = np.random.default_rng(seed)
+    y = (rng.standard_normal(int(duration * sr)) * 0.003).astype(np.float32)
+    if kind == 'click':
+        t = np.arange(int(0.03 * sr)) / sr
+        bursts = [np.sin(2 * np.pi * 1000 * t) * np.exp(-t * 150)]
+        starts = np.arange(0.5, duration - 0.1, 0.5)
+    else:
+        bursts = []
+        for length in (0.05, 0.1, 0.15):
+            t = np.arange(int(length * sr)) / sr
+            bursts.append(rng.standard_normal(len(t)) * np.exp(-t * 40))
+        starts = np.sort(rng.uniform(0.1, duration - 0.2, int(duration * 3)))
+    
+    for i, start in enumerate(starts):
+        burst = bursts[i % len(bursts)] * 0.5
+        first = int(start * sr)
+        y[first:first + len(burst)] += burst[:len(y) - first]
+    return y
+
+# Time, throughput and peak traced memory of detect_onsets (the uncached
+# part of analyze_music) on one track
+def measure_analysis(path, duration, profile=None):
+    start = time.perf_counter()
+    beatmap = detect_onsets(path, profile=profile)
+    elapsed = time.perf_counter() - start
+    
+    # Measure memory in a second run, as tracing slows the first down
+    tracemalloc.start()
+    detect_onsets(path, profile=profile)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'seconds': elapsed,
+        'audio_seconds_per_second': duration / elapsed,
+        'peak_mb': peak / (1024 * 1024),
+        'onsets': len(beatmap),
+        'streaming': duration > STREAMING_MIN_DURATION,
+    }
+
+def print_analysis_result(name, result):
+    print(f"  {name:40} {result['audio_seconds_per_second']:8.1f}x  {result['peak_mb']:7.1f} MB peak  {result['onsets']:6} onsets")
+
+# Analyze a short track with each profile first so imports and compilation aren't timed
+def warm_up_analysis(folder, profiles):
+    path = os.path.join(folder, "warm_up.wav")
+    soundfile.write(path, synthetic_audio('click', 5, ANALYSIS_SAMPLE_RATE), ANALYSIS_SAMPLE_RATE)
+    for profile in profiles:
+        detect_onsets(path, profile=profile)
+
+# Seconds of audio analyzed per second and peak memory with the current
+# profile for each kind of synthetic track, length and sample rate
+def benchmark_analysis(durations, sample_rates, kinds=('click', 'noise')):
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        warm_up_analysis(folder, [ANALYSIS_PROFILE])
+        for kind in kinds:
+            for duration in durations:
+                for sr in sample_rates:
+                    path = os.path.join(folder, f"{kind}_{duration}s_{sr}.wav")
+                    soundfile.write(path, synthetic_audio(kind, duration, sr), sr, subtype='PCM_16')
+                    name = f"analysis/{kind}/{duration}s/{sr}Hz"
+                    results[name] = dict(measure_analysis(path, duration), profile=ANALYSIS_PROFILE)
+                    print_analysis_result(name, results[name])
+                    os.remove(path)
+    return results
+
+# The cost of every analysis profile on the same tracks
+def benchmark_profiles(duration, sr=44100, kinds=('click', 'noise')):
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        warm_up_analysis(folder, ANALYSIS_PROFILES)
+        for kind in kinds:
+            path = os.path.join(folder, f"{kind}_{duration}s_{sr}.wav")
+            soundfile.write(path, synthetic_audio(kind, duration, sr), sr, subtype='PCM_16')
+            for profile in ANALYSIS_PROFILES:
+                name = f"profile/{profile}/{kind}/{duration}s"
+                results[name] = measure_analysis(path, duration, profile)
+                print_analysis_result(name, results[name])
+    return results
+
+# Time to build a chart from 1k to 100k onsets, and to thin them for every difficulty tier
+def benchmark_chart(sizes, repeats=5):
+    results = {}
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        onset_times = np.sort(rng.uniform(0, size / 4, size))
+        strengths = rng.exponential(1.0, size)
+        timings = []
+        tier_timings = []
+        for seed in range(repeats):
+            start = time.perf_counter()
+            generate_arrows(onset_times, seed)
+            timings.append(time.perf_counter() - start)
+            
+            beatmap = Beatmap(onset_times, strengths)
+            start = time.perf_counter()
+            for difficulty in DIFFICULTIES:
+                beatmap.thin(difficulty)
+            tier_timings.append(time.perf_counter() - start)
+        best = min(timings)
+        results[f"chart/{size}"] = {
+            'seconds': best,
+            'median_seconds': statistics.median(timings),
+            'notes_per_second': size / best,
+            'tiers_seconds': min(tier_timings),
+        }
+        print(f"  chart/{size:<26} {best * 1000:8.2f} ms  {size / best:12.0f} notes/s  {min(tier_timings) * 1000:8.2f} ms all tiers")
+    return results
+
+# Frame cost of the gameplay loop as more arrows are on screen, from
+# headless autoplay runs of charts with evenly spaced notes
+def benchmark_frames(densities, duration=20):
+    results = {}
+    for density in densities:
+        beat_times = np.linspace(1, duration, int(density * duration))
+        scene = PlayScene(None, Beatmap(beat_times), 'expert', 0, VirtualClock())
+        report = SimulationManager(scene).run()
+        phases = report['phase_mean_ms']
+        results[f"frame/{density}_notes_per_s"] = {
+            'update_ms': phases['update'],
+            'draw_ms': phases['draw'],
+            'update_draw_ms': phases['update'] + phases['draw'],
+            'frame_p99_ms': report['frame_ms']['p99'],
+            'frames': report['frames'],
+        }
+        print(f"  frame/{density}_notes_per_s{'':<{18 - len(str(density))}} {phases['update']:7.3f} ms update  "
+              f"{phases['draw']:7.3f} ms draw  {report['frame_ms']['p99']:7.3f} ms p99 frame")
+    return results
+
+# Time from a key press entering the event queue to its judgement, while
+# the real game loop runs. Presses are posted from another thread at
+# random moments, as the operating system would deliver them.
+def benchmark_input(presses=200):
+    beat_times = np.arange(1, 1 + presses * 0.05, 0.05)
+    scene = PlayScene(None, Beatmap(beat_times), 'expert', 0)
+    manager = SceneManager(scene)
+    posted = []
+    judged = []
+    
+    judge = scene.on_lane_key
+    def timed_judge(lane, counter):
+        judge(lane, counter)
+        judged.append(time.perf_counter())
+    scene.on_lane_key = timed_judge
+    
+    def press_keys():
+        rng = random.Random(0)
+        time.sleep(0.5)
+        for _ in range(presses):
+            time.sleep(rng.uniform(0.005, 0.03))
+            posted.append(time.perf_counter())
+            pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_LEFT))
+        time.sleep(0.1)
+        pygame.event.post(pygame.event.Event(pygame.QUIT))
+    
+    threading.Thread(target=press_keys, daemon=True).start()
+    manager.run()
+    
+    latencies = np.array(judged) - np.array(posted[:len(judged)])
+    latencies *= 1000
+    result = {
+        'presses': len(latencies),
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+    }
+    print(f"  input/press_to_judgement{'':<8} {result['p50_ms']:7.3f} ms p50  {result['p99_ms']:7.3f} ms p99  {result['max_ms']:7.3f} ms max")
+    return {'input/press_to_judgement': result}
+
+# Versions and commit the benchmark ran on, to tell results apart
+def benchmark_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'librosa': librosa.__version__,
+        'pygame': pygame.version.ver,
+    }
+
+# Print how each result changed against an earlier run
+def compare_benchmarks(old, new):
+    print(f"Compared with {old['environment']['commit']} ({old['environment']['time']}):")
+    for name, metrics in new['results'].items():
+        old_metrics = old['results'].get(name)
+        if not old_metrics:
+            continue
+        changes = []
+        for metric, value in metrics.items():
+            old_value = old_metrics.get(metric)
+            if isinstance(value, float) and old_value:
+                changes.append(f"{metric} {(value / old_value - 1) * 100:+.1f}%")
+        print(f"  {name:32} {', '.join(changes)}")
+
+BENCHMARK_SUITES = ('analysis', 'profiles', 'chart', 'frame', 'input')
+
+# Run the benchmark suites headless and write the results as JSON
+def benchmark(suites=BENCHMARK_SUITES, output_path=None, compare_path=None, quick=False):
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    init_display()
+    results = {}
+    try:
+        if 'analysis' in suites:
+            print("Analysis throughput:")
+            if quick:
+                results.update(benchmark_analysis((10, 30), (22050, 44100)))
+            else:
+                results.update(benchmark_analysis((30, 120, 660), (22050, 44100, 48000)))
+        if 'profiles' in suites:
+            print("Analysis profiles:")
+            results.update(benchmark_profiles(30 if quick else 120))
+        if 'chart' in suites:
+            print("Chart generation:")
+            results.update(benchmark_chart((1000, 10000, 100000), repeats=3 if quick else 5))
+        if 'frame' in suites:
+            print("Frame cost:")
+            results.update(benchmark_frames((1, 4, 16, 64), duration=5 if quick else 20))
+        if 'input' in suites:
+            print("Input latency:")
+            results.update(benchmark_input(50 if quick else 200))
+    finally:
+        pygame.quit()
+    
+    report = {'environment': benchmark_environment(), 'results': results}
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output_path}")
+    if compare_path:
+        with open(compare_path, 'r', encoding='utf-8') as f:
+            compare_benchmarks(json.load(f), report)
+    return report
+
+# Measure cold start: launch the game in fresh interpreters until the first menu frame
+def benchmark_startup(runs=5):
+    env = dict(os.environ, SDL_VIDEODRIVER='dummy', SDL_AUDIODRIVER='dummy', PYGAME_HIDE_SUPPORT_PROMPT='1')
+    command = [sys.executable, os.path.abspath(__file__), '--exit-after-first-frame']
+    timings = []
+    for run in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(command, env=env, capture_output=True, text=True)
+        elapsed = (time.perf_counter() - start) * 1000
+        if result.returncode != 0:
+            print(result.stderr)
+            return 1
+        timings.append(elapsed)
+        print(f"  run {run + 1}: {elapsed:.0f} ms to first frame and exit ({result.stdout.strip()})")
+    print(f"Cold start median: {statistics.median(timings):.0f} ms over {runs} runs")
+    return 0
+
+# Command line options
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Heat the beat - a rhythm game")
+    parser.add_argument('--analyze-library', nargs='?', const='assets', metavar='FOLDER',
+                        help="analyze every track in FOLDER (default: assets) and exit without opening a window")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="number of processes for --analyze-library (default: all cores)")
+    parser.add_argument('--force', action='store_true',
+                        help="re-analyze tracks that already have an up-to-date beatmap")
+    parser.add_argument('--decode-audio', action='store_true',
+                        help="also decode every track into the decoded audio cache in --analyze-library")
+    parser.add_argument('--analysis-profile', choices=ANALYSIS_PROFILES, default=None,
+                        help=f"how songs are analyzed: {', '.join(ANALYSIS_PROFILES)} (default: {ANALYSIS_PROFILE})")
+    parser.add_argument('--dirty-rects', action='store_true',
+                        help="only redraw the changed parts of the gameplay screen (F2 toggles in game)")
+    parser.add_argument('--renderer', choices=('software', 'texture'), default=None,
+                        help=f"draw in software or with GPU textures (default: {RENDER_BACKEND})")
+    parser.add_argument('--vsync', action='store_true',
+                        help="wait for the display refresh with --renderer texture (presses are read up to a refresh late)")
+    parser.add_argument('--benchmark-startup', action='store_true',
+                        help="measure the time from launch to the first menu frame and exit")
+    parser.add_argument('--exit-after-first-frame', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--difficulty', choices=DIFFICULTIES, default=None,
+                        help=f"difficulty selected at first (default: {DIFFICULTY})")
+    parser.add_argument('--audio-offset', type=int, default=None, metavar='MS',
+                        help="delay arrows and judgement by MS milliseconds to match the audio output (default: the calibrated offset)")
+    parser.add_argument('--calibrate', action='store_true',
+                        help="measure the audio, input and display latency on a click track and save it as the audio offset")
+    parser.add_argument('--audio-buffer', type=int, default=None, metavar='SAMPLES',
+                        help=f"mixer buffer size, a power of two (default: {MIXER_BUFFER}); smaller is lower latency")
+    parser.add_argument('--audio-rate', type=int, default=None, metavar='HZ',
+                        help=f"mixer sample rate (default: {MIXER_SAMPLE_RATE}); match it to your songs")
+    parser.add_argument('--simulate', nargs='?', const='', metavar='SONG',
+                        help="play SONG (default: the built-in beat) headless with autoplay and report the score and frame timings")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for the chart and autoplay of --simulate")
+    parser.add_argument('--autoplay-error', type=float, default=0.0, metavar='MS',
+                        help="standard deviation of the autoplay timing error in --simulate")
+    parser.add_argument('--report', metavar='FILE',
+                        help="write the --simulate report as JSON to FILE")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="save the --simulate run as a replay to FILE")
+    parser.add_argument('--verify-replay', nargs='+', metavar='FILE',
+                        help="judge replays again without playing them and check they reproduce their scores")
+    parser.add_argument('--check-replays', action='store_true',
+                        help="simulate a synthetic song on a fresh and a cached analysis and verify both replays")
+    parser.add_argument('--profile', action='store_true',
+                        help="print frame time statistics every few seconds (F3 shows them in game)")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="record the time of every frame phase and write it to FILE as a Chrome trace on exit")
+    parser.add_argument('--benchmark', nargs='*', choices=BENCHMARK_SUITES, metavar='SUITE',
+                        help=f"run the benchmark suites ({', '.join(BENCHMARK_SUITES)}; default: all) and exit")
+    parser.add_argument('--benchmark-output', metavar='FILE',
+                        help="write the --benchmark results as JSON to FILE")
+    parser.add_argument('--benchmark-compare', metavar='FILE',
+                        help="compare the --benchmark results with an earlier --benchmark-output file")
+    parser.add_argument('--benchmark-quick', action='store_true',
+                        help="use shorter tracks and fewer runs in --benchmark")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    AUDIO_OFFSET_MS = args.audio_offset if args.audio_offset is not None else load_calibration()
+    if args.audio_buffer:
+        MIXER_BUFFER = args.audio_buffer
+    if args.audio_rate:
+        MIXER_SAMPLE_RATE = args.audio_rate
+    if args.dirty_rects:
+        DIRTY_RECT_RENDERING = True
+    if args.renderer:
+        RENDER_BACKEND = args.renderer
+    if args.vsync:
+        RENDER_VSYNC = True
+    if args.difficulty:
+        DIFFICULTY = args.difficulty
+    if args.analysis_profile:
+        ANALYSIS_PROFILE = args.analysis_profile
+    if args.analyze_library:
+        sys.exit(analyze_library(args.analyze_library, args.jobs, args.force, args.analysis_profile, args.decode_audio))
+    if args.benchmark_startup:
+        sys.exit(benchmark_startup())
+    if args.benchmark is not None:
+        benchmark(args.benchmark or BENCHMARK_SUITES, args.benchmark_output, args.benchmark_compare, args.benchmark_quick)
+        sys.exit(0)
+    if args.calibrate:
+        calibrate()
+        sys.exit(0)
+    if args.verify_replay:
+        sys.exit(verify_replays(args.verify_replay))
+    if args.check_replays:
+        sys.exit(check_replays(args.seed, args.autoplay_error or 80.0))
+    if args.simulate is not None:
+        simulate(args.simulate or None, args.seed, args.autoplay_error, args.report, args.replay)
+        sys.exit(0)
+    profiler.log = args.profile
+    if args.trace:
+        profiler.start_trace()
+    try:
+        main(args.exit_after_first_frame)
+    finally:
+        if args.trace:
+            profiler.write_trace(args.trace)